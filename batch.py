@@ -0,0 +1,283 @@
+"""Detection over many local images and pdfs, on a pool of processes
+
+Results are written one row per file as each finishes, so that an
+interrupted run can be resumed with the same command. Files that failed are
+tried again on resuming, the latest row of a file superseding earlier ones.
+
+    python batch.py figures/ 'pdfs/**/*.pdf' --out audit.csv --workers 8
+"""
+
+import os
+import os.path
+import sys
+import csv
+import glob
+import json
+import time
+import argparse
+import concurrent.futures
+
+import pandas as pd
+
+import detect_cmap
+
+
+EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.gif', '.bmp', '.webp', '.pdf')
+
+COLUMNS = ['path', 'pages', 'rainbow', 'rainbow_pages', 'colormaps', 'seconds', 'error']
+
+
+def expand_inputs(inputs):
+    """Files from a list of files, directories (searched recursively) and
+        globs, in order and without duplicates
+    """
+    seen = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            fns = sorted(os.path.join(dirpath, fn)
+                         for dirpath, _, fns in os.walk(item) for fn in fns)
+        elif os.path.exists(item):
+            fns = [item]
+        else:
+            fns = sorted(glob.glob(item, recursive=True))
+        for fn in fns:
+            if fn.lower().endswith(EXTENSIONS) and fn not in seen:
+                seen.add(fn)
+                yield fn
+
+def init_worker():
+    # load the colormap index once per process
+    detect_cmap.get_cmap_tree()
+
+def detect_file(fn, dpi=detect_cmap.PDF_DPI, extract=detect_cmap.PDF_EXTRACT):
+    """One row of results for an image (a single page) or a pdf
+    """
+    start = time.time()
+    row = dict(path=fn, pages=0, rainbow=False, rainbow_pages='', colormaps='{}',
+               seconds=0.0, error='')
+    try:
+        if fn.lower().endswith('.pdf'):
+            source = detect_cmap.PDFSource(fn, dpi=dpi, extract=extract)
+            pages, df = detect_cmap.detect_rainbow_from_source(source)
+            row['pages'] = len(source.names())
+        else:
+            hist = detect_cmap.parse_hist(fn, name='1')
+            pages, df = detect_cmap.detect_rainbow_from_hists([hist])
+            row['pages'] = 1
+        row['rainbow'] = len(pages) > 0
+        row['rainbow_pages'] = ' '.join(str(p) for p in sorted(pages))
+        found = {}
+        for (page, cm), pct_cm in df['pct_cm'].items():
+            found.setdefault(str(page).rsplit('-', 1)[-1], {})[cm] = round(float(pct_cm), 4)
+        row['colormaps'] = json.dumps(found, sort_keys=True)
+    except Exception as e:
+        row['error'] = '{}: {}'.format(type(e).__name__, e)
+    row['seconds'] = time.time() - start
+    return row
+
+
+class CSVWriter(object):
+    """Appends rows to a csv, a line (flushed) per file
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def done(self):
+        """Paths already in the output without an error, dropping a partially
+            written last line
+        """
+        if not os.path.exists(self.path):
+            return set()
+        with open(self.path, 'rb+') as fh:
+            data = fh.read()
+            if data and not data.endswith(b'\n'):
+                fh.truncate(data.rfind(b'\n') + 1)
+        with open(self.path, 'r', newline='') as fh:
+            errors = {row['path']: row['error'] for row in csv.DictReader(fh)}
+        return set(path for path, error in errors.items() if not error)
+
+    def __enter__(self):
+        new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self.fh = open(self.path, 'a', newline='')
+        self.writer = csv.DictWriter(self.fh, COLUMNS)
+        if new:
+            self.writer.writeheader()
+        return self
+
+    def write(self, row):
+        self.writer.writerow(row)
+        self.fh.flush()
+
+    def __exit__(self, *exc):
+        self.fh.close()
+
+
+class ParquetWriter(object):
+    """Writes rows as parquet files of `chunk` rows into the directory `path`
+
+        Parts are written to a temporary name and renamed, so that an
+        interrupted run only loses the rows of the current part
+    """
+    def __init__(self, path, chunk=100):
+        self.path = path
+        self.chunk = chunk
+        self.rows = []
+
+    def parts(self):
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(os.path.join(self.path, fn) for fn in os.listdir(self.path)
+                      if fn.startswith('part-') and fn.endswith('.parquet'))
+
+    def done(self):
+        """Paths already in the output without an error
+        """
+        if not self.parts():
+            return set()
+        df = pd.concat([pd.read_parquet(part, columns=['path', 'error'])
+                        for part in self.parts()], ignore_index=True)
+        df = df.drop_duplicates('path', keep='last')
+        return set(df.loc[df['error'].fillna('') == '', 'path'])
+
+    def __enter__(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.n_parts = len(self.parts())
+        return self
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.chunk:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        fn = os.path.join(self.path, 'part-{:05d}.parquet'.format(self.n_parts))
+        pd.DataFrame(self.rows, columns=COLUMNS).to_parquet(fn + '.tmp', index=False)
+        os.replace(fn + '.tmp', fn)
+        self.n_parts += 1
+        self.rows = []
+
+    def __exit__(self, *exc):
+        self.flush()
+
+
+def open_writer(path):
+    if path.endswith('.parquet'):
+        return ParquetWriter(path)
+    return CSVWriter(path)
+
+def run_batch(fns, out, workers=None, dpi=detect_cmap.PDF_DPI,
+              extract=detect_cmap.PDF_EXTRACT, verbose=True):
+    """Detects rainbow colormaps in each of `fns` on `workers` processes,
+        writing results to `out` (.csv or a .parquet directory) as they come
+        and skipping files already there (unless they failed)
+
+        Returns a summary of the run
+    """
+    writer = open_writer(out)
+    done = writer.done()
+    todo = [fn for fn in fns if fn not in done]
+    workers = workers or os.cpu_count() or 1
+
+    start = time.time()
+    summary = dict(files=0, pages=0, rainbow=0, errors=0, skipped=len(fns) - len(todo))
+    with writer, concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=init_worker) as pool:
+        # keep a bounded number of files in flight
+        todo = iter(todo)
+        pending = set()
+        while True:
+            for fn in todo:
+                pending.add(pool.submit(detect_file, fn, dpi, extract))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                break
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                row = f.result()
+                writer.write(row)
+                summary['files'] += 1
+                summary['pages'] += row['pages']
+                summary['rainbow'] += bool(row['rainbow'])
+                summary['errors'] += bool(row['error'])
+                if verbose and row['error']:
+                    print(row['path'], row['error'], file=sys.stderr)
+
+    summary['seconds'] = time.time() - start
+    summary['files_per_s'] = summary['files'] / max(summary['seconds'], 1e-9)
+    summary['pages_per_s'] = summary['pages'] / max(summary['seconds'], 1e-9)
+    return summary
+
+
+def test_run_batch(tmpdir):
+    out = str(tmpdir.join('out.csv'))
+    fns = list(expand_inputs(['test/172627-00[0-4]*', 'test/172627_short.pdf']))
+    assert len(fns) == 6
+
+    # a partial run, interrupted mid-line
+    summary = run_batch(fns[:2], out, workers=2)
+    assert summary['files'] == 2
+    with open(out, 'a') as fh:
+        fh.write('test/172627-004.jpg,1,Tr')
+
+    summary = run_batch(fns, out, workers=2)
+    assert summary['skipped'] == 2
+    assert summary['files'] == 4
+    df = pd.read_csv(out)
+    assert sorted(df['path']) == sorted(fns)
+    assert df.set_index('path').loc['test/172627-004.jpg', 'rainbow']
+    assert df.set_index('path').loc['test/172627_short.pdf', 'rainbow_pages'] == '3 7 8 9'
+
+    # files that failed are tried again
+    bad = str(tmpdir.join('bad.png'))
+    with open(bad, 'wb') as fh:
+        fh.write(b'not an image')
+    assert run_batch([bad], out, workers=1, verbose=False)['errors'] == 1
+    with open('test/172627-006.png', 'rb') as src, open(bad, 'wb') as fh:
+        fh.write(src.read())
+    summary = run_batch(fns + [bad], out, workers=1)
+    assert (summary['files'], summary['errors'], summary['skipped']) == (1, 0, 6)
+    assert pd.read_csv(out).drop_duplicates('path', keep='last')['error'].isnull().all()
+
+def test_parquet_writer(tmpdir):
+    import pytest
+    pytest.importorskip('pyarrow')
+    out = str(tmpdir.join('out.parquet'))
+    fns = ['test/172627-004.jpg', 'test/172627-006.png']
+    run_batch(fns[:1], out, workers=1)
+    summary = run_batch(fns, out, workers=1)
+    assert summary['skipped'] == 1
+    assert sorted(pd.read_parquet(out)['path']) == fns
+
+    bad = str(tmpdir.join('bad.png'))
+    with open(bad, 'wb') as fh:
+        fh.write(b'not an image')
+    run_batch([bad], out, workers=1, verbose=False)
+    assert run_batch(fns + [bad], out, workers=1, verbose=False)['skipped'] == 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('inputs', nargs='+',
+                        help="images, pdfs, directories (searched recursively) or globs")
+    parser.add_argument('--out', required=True,
+                        help="results, as csv or (if ending in .parquet) a "
+                             "directory of parquet files")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--dpi', type=int, default=detect_cmap.PDF_DPI,
+                        help="resolution to render pdfs at")
+    parser.add_argument('--extract', action='store_true', default=detect_cmap.PDF_EXTRACT,
+                        help="read images embedded in pdfs (see detect_cmap.PDFSource)")
+    args = parser.parse_args()
+
+    fns = list(expand_inputs(args.inputs))
+    summary = run_batch(fns, args.out, args.workers, args.dpi, args.extract)
+    print('{files} files ({pages} pages) in {seconds:.1f}s: {files_per_s:.2f} files/s, '
+          '{pages_per_s:.2f} pages/s. {rainbow} with rainbow colormaps, '
+          '{errors} errors, {skipped} already done'.format(**summary))
+
+if __name__ == '__main__':
+    main()
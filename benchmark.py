@@ -0,0 +1,221 @@
+"""Benchmarks for the detection pipeline
+
+Times each stage of `detect_cmap` on the test fixtures and on generated
+figures, recording throughput and peak memory, and compares the results
+against a baseline run
+
+    python benchmark.py --save-baseline          # e.g. on master
+    python benchmark.py --baseline benchmark_baseline.json
+"""
+
+import os
+import os.path
+import sys
+import time
+import json
+import glob
+import argparse
+import platform
+import shutil
+import tempfile
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+import matplotlib
+matplotlib.use('Agg')
+
+import detect_cmap
+
+
+STAGES = ['parse_img', 'convert_to_jab', 'find_cm_dists',
+          'detect_rainbow_from_colors', 'detect_paper']
+
+
+def make_synthetic(outdir, dpis=(75, 150), seed=0):
+    """Writes a jet heatmap, a photo and a line plot as letter-sized pages
+        at each of `dpis`
+
+        Returns {dpi: [filenames]}, pages numbered in that order
+    """
+    import matplotlib.pyplot as plt
+
+    rs = np.random.RandomState(seed)
+    field = np.cumsum(np.cumsum(rs.randn(60, 80), axis=0), axis=1)
+    x = np.linspace(0, 10, 200)
+    # smooth color fields with noise, i.e. many distinct colors
+    photo = np.kron(rs.rand(12, 9, 3), np.ones((100, 100, 1)))
+    photo = photo + rs.normal(0, 0.05, photo.shape)
+
+    fns = {}
+    for dpi in dpis:
+        fns[dpi] = []
+        for page, kind in enumerate(['heatmap', 'photo', 'lineplot'], 1):
+            fig, ax = plt.subplots(figsize=(8.5, 11))
+            if kind == 'heatmap':
+                fig.colorbar(ax.imshow(field, cmap='jet'), ax=ax)
+            elif kind == 'photo':
+                ax.imshow(np.clip(photo, 0, 1), interpolation='bilinear')
+                ax.axis('off')
+            else:
+                for i in range(6):
+                    ax.plot(x, np.sin(x + i) * (i + 1), label='series {}'.format(i))
+                ax.legend()
+            ax.set_title(kind)
+            fn = os.path.join(outdir, 'synthetic{}-{}.png'.format(dpi, page))
+            fig.savefig(fn, dpi=dpi)
+            plt.close(fig)
+            fns[dpi].append(fn)
+    return fns
+
+def timed(fn, repeat=3, setup=None):
+    """Best time of `repeat` calls of `fn(setup())`, plus the peak memory
+        allocated during one (separately traced) call, in MB
+    """
+    times = []
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        start = time.perf_counter()
+        fn(arg)
+        times.append(time.perf_counter() - start)
+
+    arg = setup() if setup else None
+    tracemalloc.start()
+    try:
+        fn(arg)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), peak / 2**20
+
+def fresh(value=None):
+    """Resets the colorspace cache, so that each run starts cold
+    """
+    detect_cmap.jab_cache = detect_cmap.make_jab_cache()
+    return value
+
+def run_case(fns, repeat=3):
+    """Times each of `STAGES` on the pages `fns`
+    """
+    df = pd.concat([detect_cmap.parse_img(fn) for fn in fns], ignore_index=True)
+    jab = detect_cmap.convert_to_jab(fresh(df.copy()))
+    pages = [p for _, p in jab.groupby('fn')]
+    pixels = sum(np.prod(Image.open(fn).size) for fn in fns)
+    detect_cmap.get_cmap_tree()
+
+    stages = {
+        'parse_img': (lambda _: [detect_cmap.parse_img(fn) for fn in fns],
+                      None, pixels, 'pixels'),
+        'convert_to_jab': (detect_cmap.convert_to_jab,
+                           lambda: fresh(df.copy()), len(df), 'colors'),
+        'find_cm_dists': (lambda _: [detect_cmap.find_cm_dists(p) for p in pages],
+                          None, len(df), 'colors'),
+        'detect_rainbow_from_colors': (detect_cmap.detect_rainbow_from_colors,
+                                       lambda: fresh(df.copy()), len(df), 'colors'),
+        'detect_paper': (lambda _: detect_cmap.detect_rainbow_from_source(
+                             detect_cmap.ImageSource(fns)),
+                         fresh, pixels, 'pixels'),
+    }
+
+    results = {}
+    for stage in STAGES:
+        fn, setup, n_items, items = stages[stage]
+        seconds, peak_mb = timed(fn, repeat, setup)
+        results[stage] = dict(seconds=seconds, pages=len(fns),
+            pages_per_s=len(fns) / seconds, items=items,
+            items_per_s=n_items / seconds, peak_mb=peak_mb)
+    return results
+
+def run(cases, repeat=3):
+    return dict(
+        meta=dict(python=platform.python_version(), machine=platform.machine(),
+                  cpus=os.cpu_count(), numpy=np.__version__, pandas=pd.__version__,
+                  created=time.strftime('%Y-%m-%dT%H:%M:%S')),
+        results={name: run_case(fns, repeat) for name, fns in cases.items()})
+
+def compare(current, baseline, tolerance=0.2):
+    """Ratio of each time and peak memory to the baseline, flagging those
+        more than `tolerance` worse
+    """
+    rows = []
+    for case, stages in current['results'].items():
+        for stage, now in stages.items():
+            base = baseline['results'].get(case, {}).get(stage)
+            if base is None:
+                continue
+            time_ratio = now['seconds'] / base['seconds']
+            mem_ratio = now['peak_mb'] / max(base['peak_mb'], 1e-6)
+            rows.append(dict(case=case, stage=stage,
+                base_s=base['seconds'], now_s=now['seconds'], time_ratio=time_ratio,
+                base_mb=base['peak_mb'], now_mb=now['peak_mb'], mem_ratio=mem_ratio,
+                regression=time_ratio > 1 + tolerance or mem_ratio > 1 + tolerance))
+    return pd.DataFrame(rows, columns=['case', 'stage', 'base_s', 'now_s',
+        'time_ratio', 'base_mb', 'now_mb', 'mem_ratio', 'regression'])
+
+def report(current):
+    rows = [dict(case=case, stage=stage, **r)
+            for case, stages in current['results'].items()
+            for stage, r in stages.items()]
+    return pd.DataFrame(rows, columns=['case', 'stage', 'seconds', 'pages_per_s',
+                                       'items_per_s', 'items', 'peak_mb'])
+
+
+def test_benchmark(tmpdir):
+    fns = make_synthetic(str(tmpdir), dpis=[20])
+    current = run({'synthetic20': fns[20]}, repeat=1)
+    assert set(current['results']['synthetic20']) == set(STAGES)
+    assert not compare(current, current)['regression'].any()
+
+    slower = json.loads(json.dumps(current))
+    for r in slower['results']['synthetic20'].values():
+        r['seconds'] /= 2
+    assert compare(current, slower)['regression'].all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--out', default='benchmark_results.json')
+    parser.add_argument('--baseline', default='benchmark_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help="write the results as the baseline instead of comparing")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--dpi', default='75,150',
+                        help="resolutions of the synthetic figures")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="slowdown (or memory growth) reported as a regression")
+    parser.add_argument('--no-fixtures', action='store_true')
+    args = parser.parse_args()
+
+    cases = {}
+    if not args.no_fixtures:
+        cases['fixtures'] = sorted(glob.glob(os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), 'test', '172627-0*')))
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for dpi, fns in make_synthetic(tmpdir, [int(d) for d in args.dpi.split(',')]).items():
+            cases['synthetic{}'.format(dpi)] = fns
+        current = run(cases, args.repeat)
+    finally:
+        shutil.rmtree(tmpdir)
+    print(report(current).to_string(index=False))
+
+    out = args.baseline if args.save_baseline else args.out
+    with open(out, 'w') as fh:
+        json.dump(current, fh, indent=2)
+    print('Wrote', out)
+
+    if args.save_baseline or not os.path.exists(args.baseline):
+        return 0
+    with open(args.baseline, 'r') as fh:
+        baseline = json.load(fh)
+    df = compare(current, baseline, args.tolerance)
+    print(df.to_string(index=False, float_format='%.3f'))
+    if df['regression'].any():
+        print('{} regressions against {}'.format(df['regression'].sum(), args.baseline))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
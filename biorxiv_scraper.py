@@ -10,6 +10,8 @@ import importlib
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+import http_client
+
 try:
     from bs4 import BeautifulSoup
     iiif_biorxiv = importlib.import_module('iiif-biorxiv.app')
@@ -21,10 +23,10 @@ IIIF_HOST = os.environ.get('IIIF_HOST', 'iiif-biorxiv.saladi.org')
 def baseurl(code):
     return 'https://www.biorxiv.org/content/10.1101/{}'.format(code)
 
-def req(url):
-    http = urllib3.PoolManager(cert_reqs='CERT_NONE', assert_hostname=False)
-    page = http.request('get', url, timeout=120)
-    return page.data.decode('utf-8')
+def req(url, **kwargs):
+    """Text of a page (see `http_client`), error pages included
+    """
+    return http_client.get_text(url, verify=False, **kwargs)
 
 def test_find_authors():
     assert find_authors('121814v1') == \
@@ -60,7 +62,8 @@ def count_pages(paper_id):
     """
     url = "https://{}/iiif/2/biorxiv:{}.pdf/full/500,/0/default.jpg?page=1000"
     url = url.format(IIIF_HOST, paper_id)
-    page = req(url)
+    # the error is expected, so not retried
+    page = req(url, retry_statuses=())
     count = re_pg.findall(page)[0]
     return int(count)
 
@@ -0,0 +1,330 @@
+"""Byte caches with size-based eviction, kept on local disk or in redis
+"""
+
+import os
+import os.path
+import time
+import hashlib
+import tempfile
+import threading
+import collections
+
+
+class DiskCache(object):
+    """Entries as files under `root`
+
+        Once more than `max_bytes` are stored, the least recently used
+        entries are removed until 90% of `max_bytes` remain
+
+        The total size is kept in a file under `root` shared by all
+        processes. Concurrent updates may lose some bytes, so the directory
+        is only walked (and the total corrected) when evicting.
+    """
+    def __init__(self, root, max_bytes=2**30):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.size_path = os.path.join(root, 'size')
+        os.makedirs(root, exist_ok=True)
+        if not os.path.exists(self.size_path):
+            self.size()
+
+    def path(self, key):
+        h = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, h[:2], h[2:])
+
+    def get(self, key):
+        fn = self.path(key)
+        try:
+            with open(fn, 'rb') as fh:
+                data = fh.read()
+            # mark as recently used
+            os.utime(fn, None)
+        except OSError:
+            return None
+        return data
+
+    def put(self, key, data):
+        fn = self.path(key)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        try:
+            old = os.stat(fn).st_size
+        except OSError:
+            old = 0
+
+        # write and rename, so that readers never see a partial entry
+        fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(fn))
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmp_fn, fn)
+
+        if self.add_size(len(data) - old) > self.max_bytes:
+            self.evict()
+
+    def delete(self, key):
+        fn = self.path(key)
+        try:
+            size = os.stat(fn).st_size
+            os.remove(fn)
+        except OSError:
+            return
+        self.add_size(-size)
+
+    def entries(self):
+        """(last used, size, path) of each entry
+        """
+        for dirpath, _, fns in os.walk(self.root):
+            # entries are in subdirectories, the size file at the top
+            if dirpath == self.root:
+                continue
+            for fn in fns:
+                path = os.path.join(dirpath, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+    def write_size(self, size):
+        fd, tmp_fn = tempfile.mkstemp(dir=self.root, prefix='.size-')
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(str(size))
+        os.replace(tmp_fn, self.size_path)
+
+    def size(self):
+        try:
+            with open(self.size_path, 'r') as fh:
+                return int(fh.read())
+        except (OSError, ValueError):
+            # not recorded yet (a new cache directory) or unreadable
+            size = sum(size for _, size, _ in self.entries())
+            self.write_size(size)
+            return size
+
+    def add_size(self, delta):
+        size = max(self.size() + delta, 0)
+        self.write_size(size)
+        return size
+
+    def evict(self, target=0.9):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= target * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self.write_size(total)
+
+
+# KEYS: entry, use times, sizes, total size; ARGV: key, data, time
+# (as scripts, so that the total is updated atomically with the entry)
+REDIS_PUT = """
+local old = tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or 0)
+redis.call('SET', KEYS[1], ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[1])
+redis.call('HSET', KEYS[3], ARGV[1], string.len(ARGV[2]))
+return redis.call('INCRBY', KEYS[4], string.len(ARGV[2]) - old)
+"""
+
+REDIS_DELETE = """
+local old = tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or 0)
+redis.call('DEL', KEYS[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+return redis.call('DECRBY', KEYS[4], old)
+"""
+
+class RedisCache(object):
+    """Entries as redis keys under `prefix`
+
+        Use times and sizes are tracked alongside, so that the least recently
+        used entries are removed once more than `max_bytes` are stored
+    """
+    def __init__(self, conn, max_bytes=2**28, prefix='jetfighter:cache:'):
+        self.conn = conn
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self._put = conn.register_script(REDIS_PUT)
+        self._delete = conn.register_script(REDIS_DELETE)
+
+    def _keys(self, key):
+        return [self.prefix + key, self.prefix + '_used',
+                self.prefix + '_sizes', self.prefix + '_total']
+
+    def get(self, key):
+        data = self.conn.get(self.prefix + key)
+        if data is not None:
+            self.conn.zadd(self.prefix + '_used', {key: time.time()})
+        return data
+
+    def put(self, key, data):
+        total = self._put(keys=self._keys(key), args=[key, data, time.time()])
+        if total > self.max_bytes:
+            self.evict()
+
+    def delete(self, key):
+        self._delete(keys=self._keys(key), args=[key])
+
+    def size(self):
+        return int(self.conn.get(self.prefix + '_total') or 0)
+
+    def evict(self, target=0.9, batch=100):
+        while self.size() > target * self.max_bytes:
+            oldest = self.conn.zrange(self.prefix + '_used', 0, batch - 1)
+            if not oldest:
+                break
+            for key in oldest:
+                self.delete(key.decode('utf-8'))
+
+
+class MemoryCache(object):
+    """Entries in a dict of this process, least recently used removed first
+        once more than `max_bytes` are stored
+    """
+    def __init__(self, max_bytes=2**24):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            self._size += len(data) - len(self.entries.pop(key, b''))
+            self.entries[key] = data
+            while self._size > self.max_bytes and self.entries:
+                self._size -= len(self.entries.popitem(last=False)[1])
+
+    def delete(self, key):
+        with self._lock:
+            self._size -= len(self.entries.pop(key, b''))
+
+    def size(self):
+        return self._size
+
+
+class TieredCache(object):
+    """Looks up entries in each of `caches` in turn (e.g. in process, then
+        in redis), copying those found into the earlier ones
+
+        A cache that fails (e.g. redis being unreachable) is skipped
+    """
+    def __init__(self, caches):
+        self.caches = caches
+
+    def get(self, key):
+        for i, cache in enumerate(self.caches):
+            try:
+                data = cache.get(key)
+            except Exception:
+                continue
+            if data is not None:
+                for c in self.caches[:i]:
+                    c.put(key, data)
+                return data
+        return None
+
+    def put(self, key, data):
+        for cache in self.caches:
+            try:
+                cache.put(key, data)
+            except Exception:
+                pass
+
+    def delete(self, key):
+        for cache in self.caches:
+            try:
+                cache.delete(key)
+            except Exception:
+                pass
+
+
+def open_cache(spec, max_bytes, prefix='jetfighter:cache:'):
+    """A `RedisCache` if `spec` is a redis url, otherwise a `DiskCache`
+        in the directory `spec`
+    """
+    if spec.startswith(('redis://', 'rediss://', 'unix://')):
+        import redis
+        return RedisCache(redis.from_url(spec), max_bytes=max_bytes, prefix=prefix)
+    return DiskCache(spec, max_bytes=max_bytes)
+
+
+def test_disk_cache(tmpdir):
+    cache = DiskCache(str(tmpdir), max_bytes=1000)
+    assert cache.get('a') is None
+
+    cache.put('a', b'x' * 400)
+    cache.put('b', b'y' * 400)
+    assert cache.get('a') == b'x' * 400
+
+    # make 'b' the least recently used
+    os.utime(cache.path('b'), (0, 0))
+    cache.put('c', b'z' * 400)
+    assert cache.get('b') is None
+    assert cache.get('a') == b'x' * 400
+    assert cache.size() <= 900
+
+    # overwrites replace the entry's size, entries of other processes are
+    # counted (through the shared total) without walking the directory
+    cache = DiskCache(str(tmpdir.mkdir('sizes')), max_bytes=1000)
+    other = DiskCache(cache.root, max_bytes=1000)
+    for _ in range(5):
+        cache.put('a', b'x' * 400)
+    assert cache.size() == 400
+    other.put('b', b'y' * 400)
+    os.utime(cache.path('a'), (0, 0))
+    cache.put('c', b'z' * 400)
+    assert cache.get('a') is None
+    assert cache.size() == DiskCache(cache.root).size() == 800
+
+def test_redis_cache():
+    import redis
+    import pytest
+    conn = redis.from_url(os.environ.get('TEST_REDIS_URL', 'redis://localhost:6379/15'))
+    try:
+        conn.ping()
+    except redis.ConnectionError:
+        pytest.skip("No redis server to test against")
+    prefix = 'jetfighter:test:{}:'.format(os.getpid())
+    cache = RedisCache(conn, max_bytes=1000, prefix=prefix)
+    try:
+        for _ in range(5):
+            cache.put('a', b'x' * 400)
+        assert cache.size() == 400
+        cache.put('b', b'y' * 400)
+        cache.get('a')
+        cache.put('c', b'z' * 400)
+        assert cache.get('b') is None
+        assert cache.get('a') == b'x' * 400
+        cache.delete('a')
+        assert cache.size() == 400
+    finally:
+        for key in conn.scan_iter(prefix + '*'):
+            conn.delete(key)
+
+def test_tiered_cache(tmpdir):
+    memory = MemoryCache(max_bytes=1000)
+    disk = DiskCache(str(tmpdir))
+    cache = TieredCache([memory, disk])
+
+    disk.put('a', b'x' * 400)
+    assert cache.get('a') == b'x' * 400
+    assert memory.get('a') == b'x' * 400
+
+    cache.put('b', b'y' * 400)
+    cache.put('c', b'z' * 400)
+    assert memory.get('a') is None
+    assert memory.size() == 800
+
+    cache.delete('b')
+    assert cache.get('b') is None
+    assert disk.get('b') is None
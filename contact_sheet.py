@@ -0,0 +1,71 @@
+"""Contact sheets: the pages of a paper as tiles of a single image, so that
+previews take one request instead of one per page
+"""
+
+import io
+import math
+
+from PIL import Image, ImageOps
+
+
+# size of the box each page is fitted into (letter proportions)
+TILE = (150, 194)
+COLUMNS = 10
+HIGHLIGHT = (70, 25, 105)
+
+
+def sheet_layout(page_count, tile=TILE, columns=COLUMNS):
+    """Size of the sheet and offset (x, y) of each page (1-indexed)
+    """
+    columns = max(1, min(columns, page_count))
+    rows = max(1, int(math.ceil(page_count / columns)))
+    offsets = {page: (((page - 1) % columns) * tile[0], ((page - 1) // columns) * tile[1])
+               for page in range(1, page_count + 1)}
+    return dict(width=columns * tile[0], height=rows * tile[1],
+                tile=list(tile), columns=columns, rows=rows, offsets=offsets)
+
+def make_sheet(images, page_count, detected=(), tile=TILE, columns=COLUMNS,
+               border=4, quality=80):
+    """Jpeg of `images` ({page: image bytes}) tiled as in `sheet_layout`,
+        with a border around the `detected` pages
+
+        Pages missing from `images` (or that can't be read) are left blank
+    """
+    layout = sheet_layout(page_count, tile, columns)
+    sheet = Image.new('RGB', (layout['width'], layout['height']), 'white')
+    for page, (x, y) in layout['offsets'].items():
+        try:
+            im = Image.open(io.BytesIO(images[page])).convert('RGBA')
+        except (KeyError, OSError):
+            continue
+        # transparent areas as white paper
+        im = Image.alpha_composite(Image.new('RGBA', im.size, 'white'), im).convert('RGB')
+        im.thumbnail((tile[0] - 2 * border, tile[1] - 2 * border), Image.LANCZOS)
+        if page in detected:
+            im = ImageOps.expand(im, border, HIGHLIGHT)
+        sheet.paste(im, (x + (tile[0] - im.width) // 2, y + (tile[1] - im.height) // 2))
+
+    buf = io.BytesIO()
+    sheet.save(buf, 'JPEG', quality=quality)
+    return buf.getvalue()
+
+
+def test_make_sheet():
+    images = {}
+    for page, fn in enumerate(['test/172627-000.png', 'test/172627-004.jpg'], 1):
+        with open(fn, 'rb') as fh:
+            images[page] = fh.read()
+    images[3] = b'not an image'
+
+    layout = sheet_layout(13, columns=5)
+    assert (layout['width'], layout['height']) == (5 * TILE[0], 3 * TILE[1])
+    assert layout['offsets'][7] == (TILE[0], TILE[1])
+
+    sheet = Image.open(io.BytesIO(make_sheet(images, 13, detected=[2], columns=5)))
+    assert sheet.size == (layout['width'], layout['height'])
+    # a border around the detected page, the unreadable one left blank
+    x, y = layout['offsets'][2]
+    edge = [sheet.getpixel((x + TILE[0] // 2, y + j)) for j in range(TILE[1])]
+    assert any(max(abs(a - b) for a, b in zip(p, HIGHLIGHT)) < 30 for p in edge)
+    x, y = layout['offsets'][3]
+    assert min(sheet.crop((x, y, x + TILE[0], y + TILE[1])).convert('L').getdata()) > 240
@@ -5,6 +5,7 @@ CREATE TABLE `biorxiv` (
  `source` varchar(10) COLLATE utf8mb4_unicode_ci NOT NULL DEFAULT 'biorxiv',
  `id` varchar(10) COLLATE utf8mb4_unicode_ci NOT NULL,
  `created` datetime NOT NULL,
+ `updated` datetime(6) DEFAULT NULL,
  `title` text COLLATE utf8mb4_unicode_ci NOT NULL,
  `parse_status` smallint(1) NOT NULL DEFAULT '0',
  `parse_data` mediumtext COLLATE utf8mb4_unicode_ci,
@@ -16,6 +17,30 @@ CREATE TABLE `biorxiv` (
  PRIMARY KEY (`id`),
  UNIQUE KEY `id` (`id`),
  KEY `parse_status` (`parse_status`),
- KEY `page_count` (`page_count`)
-)
+ KEY `page_count` (`page_count`),
+ KEY `created_status` (`created`, `parse_status`),
+ KEY `posted_date_id` (`posted_date`, `id`),
+ KEY `parse_status_id` (`parse_status`, `id`)
+);
 
+CREATE TABLE `biorxiv_page` (
+ `paper_id` varchar(10) COLLATE utf8mb4_unicode_ci NOT NULL,
+ `page` smallint(5) unsigned NOT NULL,
+ `cm` varchar(32) COLLATE utf8mb4_unicode_ci NOT NULL,
+ `pct_cm` float NOT NULL,
+ `pct_page` float NOT NULL,
+ PRIMARY KEY (`paper_id`, `page`, `cm`),
+ KEY `cm_pct_cm` (`cm`, `pct_cm`),
+ FOREIGN KEY (`paper_id`) REFERENCES `biorxiv` (`id`) ON DELETE CASCADE
+);
+
+CREATE TABLE `job_metrics` (
+ `id` int(11) NOT NULL AUTO_INCREMENT,
+ `paper_id` varchar(10) COLLATE utf8mb4_unicode_ci NOT NULL,
+ `created` datetime NOT NULL,
+ `total` float NOT NULL,
+ `data` text COLLATE utf8mb4_unicode_ci NOT NULL,
+ PRIMARY KEY (`id`),
+ KEY `paper_id` (`paper_id`),
+ KEY `created` (`created`)
+);
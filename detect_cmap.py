@@ -7,6 +7,16 @@ import argparse
 import glob
 import urllib
 import itertools
+import collections
+import json
+import hashlib
+import tempfile
+import shutil
+import io
+import concurrent.futures
+
+import metrics
+import http_client
 
 try:
     import numpy as np
@@ -15,53 +25,235 @@ try:
 
     import skimage.io
     import skimage.color
-    import matplotlib.pyplot as plt
+    import skimage.util
+    import matplotlib
+    import colorspacious
     from colorspacious import cspace_convert
+    from PIL import Image
 except:
     print('Calculations will fail if this is a worker')
 
+# optional, for rendering pdfs without the iiif server
+try:
+    import fitz
+except ImportError:
+    fitz = None
+
 IIIF_HOST = os.environ.get('IIIF_HOST', 'iiif-biorxiv.saladi.org')
 
-def parse_img(fn, name=None):
-    """Parses an image file into a dataframe of R, G, B color counts
-        Pure white and black are removed to reduce the size of the calculation
+# 'concurrent' or 'serial' (one page at a time, as originally done)
+IIIF_FETCH_MODE = os.environ.get('IIIF_FETCH_MODE', 'concurrent')
+IIIF_FETCH_WORKERS = int(os.environ.get('IIIF_FETCH_WORKERS', 8))
+# 0 decodes in the fetching threads instead of separate processes
+IIIF_DECODE_WORKERS = int(os.environ.get('IIIF_DECODE_WORKERS', os.cpu_count() or 1))
+IIIF_TIMEOUT = float(os.environ.get('IIIF_TIMEOUT', 120))
+IIIF_RETRIES = int(os.environ.get('IIIF_RETRIES', 3))
+# IIIF size of page renders, e.g. 'full' or '!800,800'
+IIIF_SIZE = os.environ.get('IIIF_SIZE', 'full')
+# if set, pages scored within IIIF_REFINE_MARGIN of the detection threshold
+# at IIIF_SIZE are retrieved again at this size
+IIIF_REFINE_SIZE = os.environ.get('IIIF_REFINE_SIZE', '')
+IIIF_REFINE_MARGIN = float(os.environ.get('IIIF_REFINE_MARGIN', 0.25))
+# resolution of local pdf renders
+PDF_DPI = int(os.environ.get('PDF_DPI', 150))
+# read embedded images of local pdfs instead of rendering every page
+PDF_EXTRACT = bool(int(os.environ.get('PDF_EXTRACT', 0)))
+# stop after this many pages with a rainbow colormap (0 to check every page)
+DETECT_TRIAGE = int(os.environ.get('DETECT_TRIAGE', 0))
+# skip colormap matching on pages without enough colors near the entries of
+# any rainbow colormap (see `rainbow_bound`)
+DETECT_PREFILTER = bool(int(os.environ.get('DETECT_PREFILTER', 0)))
+# neighboring cells (of a `max_diff` wide grid over CAM02-UCS) searched
+# around each rainbow colormap entry for page colors; 1 never skips a page
+# that matching would flag, 0 skips more but may miss some
+PREFILTER_SLACK = int(os.environ.get('PREFILTER_SLACK', 1))
+# bytes of temporaries allowed when counting the colors of a page (0 for no
+# limit); larger pages are counted in strips of rows
+PARSE_MEMORY_BUDGET = int(os.environ.get('PARSE_MEMORY_BUDGET', 0))
+# bytes used per pixel while counting colors (compositing RGBA is the worst case)
+PARSE_BYTES_PER_PIXEL = 32
+
+def pack_rgb(rgb):
+    """Packs an (..., 3) array of 8-bit R, G, B values into 24-bit integers
     """
-    try:
-        im = skimage.io.imread(fn)
-    except urllib.error.HTTPError as e:
-        print(fn, name)
-        raise e
+    rgb = np.asarray(rgb)
+    packed = rgb[..., 0].astype(np.uint32) << 16
+    packed |= rgb[..., 1].astype(np.uint32) << 8
+    packed |= rgb[..., 2].astype(np.uint32)
+    return packed
+
+def unpack_rgb(packed):
+    """Inverse of `pack_rgb`, returns an (N, 3) uint8 array
+    """
+    packed = np.asarray(packed, dtype=np.uint32)
+    rgb = np.empty((packed.size, 3), dtype=np.uint8)
+    rgb[:, 0] = packed >> 16
+    rgb[:, 1] = (packed >> 8) & 0xFF
+    rgb[:, 2] = packed & 0xFF
+    return rgb
+
+
+class ColorHist(collections.namedtuple('ColorHist', ['name', 'colors', 'counts', 'key'])):
+    """Histogram of the colors on a page
+
+        `colors` are the unique 24-bit packed colors (sorted) and `counts`
+        the number of pixels with each color. `key` identifies the page
+        image in the page cache, if known.
+    """
+    __slots__ = ()
+
+    def __new__(cls, name, colors, counts, key=None):
+        return super(ColorHist, cls).__new__(cls, name, colors, counts, key)
+
+    @property
+    def size(self):
+        return self.colors.size
+
+    def to_frame(self):
+        """Expands into the `R, G, B, count, fn` dataframe used downstream
+        """
+        col = pd.DataFrame(unpack_rgb(self.colors), columns=['R', 'G', 'B'])
+        col['count'] = self.counts
+        col['fn'] = self.name
+        return col
+
+def img_to_rgb(im):
+    """Coerces a decoded image into an 8-bit RGB array
+
+        Grayscale images carry no color information and give None.
+        Palette images (if passed as PIL images) are expanded, 16-bit and
+        float images are rescaled and RGBA is composited onto white
+    """
+    if hasattr(im, 'mode'):
+        if im.mode in ('P', 'PA'):
+            im = im.convert('RGBA')
+        im = np.asarray(im)
+
+    # Nothing to parse if grayscale (or grayscale + alpha)
+    if im.ndim == 2 or im.shape[2] < 3:
+        return None
+
+    if im.dtype != np.uint8:
+        im = skimage.util.img_as_ubyte(im)
 
-    # Check that we have an RGB array (as opposed to grayscale/RGBA)
-    # Nothing to parse if grayscale
-    if len(im.shape) == 2 or im.shape[2] < 3:
-        return pd.DataFrame()
-    
-    # Convert to RGB if RGBA
     if im.shape[2] == 4:
-        im = skimage.color.rgba2rgb(im)
+        # same as skimage.color.rgba2rgb with a white background,
+        # but stays in integer space
+        alpha = im[..., 3:].astype(np.uint16)
+        rgb = im[..., :3] * alpha + 255 * (255 - alpha) + 127
+        im = (rgb // 255).astype(np.uint8)
 
-    # Remove white and black first (large reduction in size of array)
-    # NOTE: assumes an 8-bit image
-    im = im[np.sum(im, axis=2) != 255*3]
-    im = im[np.sum(im, axis=1) != 0]
+    return im[..., :3]
 
-    if im.size == 0:
+def strip_rows(width, budget=PARSE_MEMORY_BUDGET):
+    """Rows of an image `width` wide that can be counted within `budget`
+        (None for no limit)
+    """
+    if not budget:
         return None
+    return max(1, int(budget // (max(width, 1) * PARSE_BYTES_PER_PIXEL)))
+
+def image_strips(im, budget=PARSE_MEMORY_BUDGET):
+    """Yields an image (array or PIL image) whole or, if it can't be
+        counted within `budget`, in strips of rows
+    """
+    if hasattr(im, 'mode'):
+        width, height = im.size
+    elif im.ndim >= 2:
+        height, width = im.shape[:2]
+    else:
+        height = width = 0
+
+    rows = strip_rows(width, budget)
+    if rows is None or rows >= height:
+        yield im
+        return
+    for top in range(0, height, rows):
+        if hasattr(im, 'mode'):
+            yield im.crop((0, top, width, min(top + rows, height)))
+        else:
+            yield im[top:top + rows]
+
+def sum_hists(hists, name):
+    """`merge_hists` over an iterable, merging as it goes so that only about
+        twice the final histogram is held
+    """
+    total = None
+    pending = []
+    n_pending = 0
+    for hist in hists:
+        pending.append(hist)
+        n_pending += hist.size
+        if total is None:
+            total, pending, n_pending = hist, [], 0
+        elif n_pending >= total.size:
+            total = merge_hists([total] + pending, name)
+            pending, n_pending = [], 0
+    if total is None:
+        return merge_hists([], name)
+    if pending:
+        total = merge_hists([total] + pending, name)
+    return total
+
+def color_hist(im, name, budget=PARSE_MEMORY_BUDGET):
+    """Counts the colors of a decoded image
+
+        Pure white and black are removed to reduce the size of the calculation
+
+        With a `budget`, images too large to count at once are counted in
+        strips of rows, which gives the same histogram
+    """
+    def strip_hists():
+        for strip in image_strips(im, budget):
+            rgb = img_to_rgb(strip)
+            if rgb is None:
+                return
+
+            packed = pack_rgb(rgb).ravel()
+            packed = packed[(packed != 0) & (packed != 0xFFFFFF)]
 
-    # im = im.reshape(im.shape[0] * im.shape[1], 3)
-    im = pd.DataFrame.from_records(im, columns=['R', 'G', 'B'])
+            colors, counts = np.unique(packed, return_counts=True)
+            yield ColorHist(name, colors, counts.astype(np.int64))
 
-    # count occurrences of each color and then clean up columns
-    col = im.groupby(im.columns.tolist()).size()
-    col = col.reset_index().rename(columns={0: 'count'})
+    with metrics.timer('histogram'):
+        hist = sum_hists(strip_hists(), name)
+    metrics.count('unique_colors', hist.size)
+    return hist
 
+def merge_hists(hists, name):
+    """Sums several `ColorHist`s (e.g. of the images on a page) into one
+    """
+    hists = [h for h in hists if h.size > 0]
+    if not hists:
+        return ColorHist(name, np.empty(0, dtype=np.uint32),
+                         np.empty(0, dtype=np.int64))
+    colors, inverse = np.unique(np.concatenate([h.colors for h in hists]),
+                                return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=np.concatenate([h.counts for h in hists]))
+    return ColorHist(name, colors, counts.astype(np.int64))
+
+def parse_hist(fn, name=None):
+    """Reads an image file (or url) into a `ColorHist`
+    """
     if name is None:
-        col['fn'], _ = os.path.splitext(os.path.basename(fn))
-    else:
-        col['fn'] = name
+        name, _ = os.path.splitext(os.path.basename(fn))
 
-    return col
+    try:
+        if fn.startswith(('http://', 'https://')):
+            im = skimage.io.imread(io.BytesIO(fetch_page(fn)))
+        else:
+            im = skimage.io.imread(fn)
+    except urllib.error.HTTPError as e:
+        print(fn, name)
+        raise e
+
+    return color_hist(im, name)
+
+def parse_img(fn, name=None):
+    """Parses an image file into a dataframe of R, G, B color counts
+        Pure white and black are removed to reduce the size of the calculation
+    """
+    return parse_hist(fn, name).to_frame()
 
 
 # Have colormaps separated into categories:
@@ -91,31 +283,254 @@ cmap_names = [('Perceptually Uniform Sequential', [
 # don't keep grey colormaps
 drop_maps = ['Greys', 'binary', 'gist_yarg', 'gist_gray', 'gray']
 
-def build_cmap_knn(n=256):
-    """Builds a nearest neighbor graph for each colormap in matplotlib
+def sample_cmaps(n=256):
+    """Samples `n` colors from each colormap in matplotlib into CAM02-UCS
     """
+    import matplotlib.pyplot as plt
+
     # matplotlib.cm.ScalarMappable(cmap=plt.get_cmap('jet')).to_rgba([.1, 0.5, .9], alpha=False, bytes=True)
-    cmaps = {}
+    cmaps = collections.OrderedDict()
     cm_names = [cat[1] for cat in cmap_names]
     for name in itertools.chain.from_iterable(cm_names):
         if name not in drop_maps:
             cm = plt.get_cmap(name)
             cmaps[name] = cm(np.linspace(0, 1, n))[:,:3]
             cmaps[name] = cspace_convert(cmaps[name], "sRGB1", "CAM02-UCS")
-            cmaps[name] = NearestNeighbors(n_neighbors=1, metric='euclidean').fit(cmaps[name])
     return cmaps
 
+def build_cmap_knn(n=256, cmap_jab=None):
+    """Builds a nearest neighbor graph for each colormap in matplotlib
+    """
+    if cmap_jab is None:
+        cmap_jab = sample_cmaps(n)
+    return collections.OrderedDict(
+        (name, NearestNeighbors(n_neighbors=1, metric='euclidean').fit(jab))
+        for name, jab in cmap_jab.items())
+
+CmapTree = collections.namedtuple('CmapTree',
+    ['names', 'n', 'knn', 'label', 'entry', 'tie_knn'])
+
+def build_cmap_tree(n=256, cmap_jab=None):
+    """Builds a single nearest neighbor graph over the colors of all colormaps
+
+        Each point is labeled with the index of its colormap (`label`) and
+        its position in that colormap (`entry`).
+
+        Colormaps with repeated colors (e.g. qualitative maps) also keep their
+        own graph in `tie_knn` so that the entry picked among equally near
+        duplicates is the same as `build_cmap_knn` would give
+    """
+    if cmap_jab is None:
+        cmap_jab = sample_cmaps(n)
+    names = list(cmap_jab.keys())
+    knn = NearestNeighbors(metric='euclidean').fit(
+        np.concatenate([cmap_jab[name] for name in names]))
+    label = np.repeat(np.arange(len(names)), n)
+    entry = np.tile(np.arange(n), len(names))
+    tie_knn = {i: NearestNeighbors(n_neighbors=1, metric='euclidean').fit(cmap_jab[name])
+               for i, name in enumerate(names)
+               if len(np.unique(cmap_jab[name], axis=0)) < n}
+    return CmapTree(names, n, knn, label, entry, tie_knn)
+
+CMAP_INDEX = os.environ.get('CMAP_INDEX', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'cmap_index.npz'))
+
+def cmap_index_checksum(n=256):
+    """Identifies the colormap samples that matplotlib and colorspacious
+        would currently give
+    """
+    names = [name for name in itertools.chain.from_iterable(
+        cat[1] for cat in cmap_names) if name not in drop_maps]
+    key = [n, names, matplotlib.__version__, colorspacious.__version__]
+    return hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+
+def save_cmap_index(fn=CMAP_INDEX, n=256):
+    """Samples the colormaps and writes them to `fn` as plain arrays
+    """
+    cmap_jab = sample_cmaps(n)
+
+    # write and rename, so that a concurrent reader never sees a partial file
+    fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fn)))
+    with os.fdopen(fd, 'wb') as fh:
+        np.savez(fh, names=np.array(list(cmap_jab.keys())),
+                 jab=np.stack(list(cmap_jab.values())),
+                 checksum=np.array(cmap_index_checksum(n)))
+    os.chmod(tmp_fn, 0o644)
+    os.replace(tmp_fn, fn)
+    return cmap_jab
+
+def load_cmap_index(fn=CMAP_INDEX, n=256):
+    """Reads the colormap samples from `fn`, rebuilding them if the file is
+        missing or was written for other library versions
+    """
+    if os.path.exists(fn):
+        with np.load(fn, allow_pickle=False) as data:
+            if str(data['checksum']) == cmap_index_checksum(n):
+                return collections.OrderedDict(zip(data['names'].tolist(), data['jab']))
+    try:
+        return save_cmap_index(fn, n)
+    except OSError:
+        # e.g. read-only deployment, just keep it in memory
+        return sample_cmaps(n)
+
+_cmap_index = {}
+
+def get_cmap_jab():
+    if 'jab' not in _cmap_index:
+        _cmap_index['jab'] = load_cmap_index()
+    return _cmap_index['jab']
+
+def get_cmap_knn():
+    """Per colormap nearest neighbor graphs, built on first use
+    """
+    if 'knn' not in _cmap_index:
+        _cmap_index['knn'] = build_cmap_knn(cmap_jab=get_cmap_jab())
+    return _cmap_index['knn']
+
+def get_cmap_tree():
+    """Fused nearest neighbor graph over all colormaps, built on first use
+    """
+    if 'tree' not in _cmap_index:
+        _cmap_index['tree'] = build_cmap_tree(cmap_jab=get_cmap_jab())
+    return _cmap_index['tree']
+
+
+class JabCache(object):
+    """Memoizes sRGB255 -> CAM02-UCS conversions keyed on packed RGB colors
+
+        With `maxsize=None`, values live in a dense table over the whole sRGB
+        cube that is filled in as colors are seen (memory-mapped from `path`
+        if given, so that it outlives the worker). Otherwise at most
+        `maxsize` colors are kept and the least recently used are evicted.
+    """
+    def __init__(self, maxsize=None, path=None):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._tick = 0
+
+        if maxsize is not None:
+            self.keys = np.empty(0, dtype=np.uint32)
+            self.values = np.empty((0, 3))
+            self.used = np.empty(0, dtype=np.int64)
+        elif path is not None:
+            try:
+                self.values = np.lib.format.open_memmap(path + '.values.npy', mode='r+')
+                self.filled = np.lib.format.open_memmap(path + '.filled.npy', mode='r+')
+                if self.values.shape != (1 << 24, 3) or self.filled.shape != (1 << 24,):
+                    raise ValueError("unexpected shape")
+            except (OSError, ValueError):
+                # missing (e.g. an interrupted first run) or unreadable
+                self.values, self.filled = self.create(path)
+        else:
+            # zeroed pages are only backed by memory once written to
+            self.values = np.zeros((1 << 24, 3))
+            self.filled = np.zeros(1 << 24, dtype=bool)
+
+    @staticmethod
+    def create(path):
+        """Empty tables at `path`, written under temporary names and renamed
+            into place so that other workers never open partial files
+
+            `filled` is replaced first, so that a worker opening the tables
+            meanwhile never pairs new (empty) values with old `filled` flags
+        """
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        values = np.lib.format.open_memmap(tmp + '.values.npy',
+            mode='w+', dtype=np.float64, shape=(1 << 24, 3))
+        filled = np.lib.format.open_memmap(tmp + '.filled.npy',
+            mode='w+', dtype=bool, shape=(1 << 24,))
+        values.flush()
+        filled.flush()
+        os.replace(tmp + '.filled.npy', path + '.filled.npy')
+        os.replace(tmp + '.values.npy', path + '.values.npy')
+        return values, filled
+
+    def __len__(self):
+        if self.maxsize is None:
+            return int(np.count_nonzero(self.filled))
+        return self.keys.size
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, size=len(self),
+                    hit_rate=self.hits / total if total else 0.)
+
+    def convert(self, packed):
+        """CAM02-UCS coordinates, an (N, 3) array, for each packed color
+        """
+        packed = np.asarray(packed, dtype=np.uint32)
+        if self.maxsize is None:
+            hit = self.filled[packed]
+            miss = np.unique(packed[~hit])
+            if miss.size:
+                self.values[miss] = cspace_convert(unpack_rgb(miss), 'sRGB255', 'CAM02-UCS')
+                self.filled[miss] = True
+            jab = self.values[packed]
+        else:
+            jab, hit = self._convert_lru(packed)
+
+        n_hit = int(np.count_nonzero(hit))
+        self.hits += n_hit
+        self.misses += packed.size - n_hit
+        return jab
+
+    def _convert_lru(self, packed):
+        self._tick += 1
+        jab = np.empty((packed.size, 3))
+
+        pos = np.minimum(np.searchsorted(self.keys, packed), max(self.keys.size - 1, 0))
+        if self.keys.size:
+            hit = self.keys[pos] == packed
+        else:
+            hit = np.zeros(packed.size, dtype=bool)
+        jab[hit] = self.values[pos[hit]]
+        self.used[pos[hit]] = self._tick
+
+        miss = np.unique(packed[~hit])
+        if miss.size == 0:
+            return jab, hit
+        new = cspace_convert(unpack_rgb(miss), 'sRGB255', 'CAM02-UCS')
+        jab[~hit] = new[np.searchsorted(miss, packed[~hit])]
+
+        keys = np.concatenate([self.keys, miss])
+        values = np.concatenate([self.values, new])
+        used = np.concatenate([self.used, np.full(miss.size, self._tick)])
+        if keys.size > self.maxsize:
+            keep = np.sort(np.argsort(-used, kind='stable')[:self.maxsize])
+            keys, values, used = keys[keep], values[keep], used[keep]
+        order = np.argsort(keys)
+        self.keys, self.values, self.used = keys[order], values[order], used[order]
+
+        return jab, hit
+
+def make_jab_cache(size=os.environ.get('JAB_CACHE_SIZE', str(1 << 20)),
+                   path=os.environ.get('JAB_CACHE_PATH')):
+    """`size` is the number of colors to keep, 'full' for the whole sRGB
+        cube (required with `path`) or 0 to not cache
+    """
+    if size == 'full':
+        return JabCache(path=path)
+    if int(size) > 0:
+        return JabCache(maxsize=int(size))
+    return None
+
 try:
-    cmap_knn = build_cmap_knn()
+    jab_cache = make_jab_cache()
 except:
-    print("Calculations will fail if this is a worker")
+    jab_cache = None
 
 
 def convert_to_jab(df, from_cm='sRGB255', from_cols=['R', 'G', 'B']):
     """Converts a dataframe inplace from one color map to JCAM02-UCS
         Will delete originating columns
+
+        sRGB255 colors go through `jab_cache`, if enabled
     """
-    arr_tmp = cspace_convert(df[from_cols], from_cm, 'CAM02-UCS')
+    if from_cm == 'sRGB255' and jab_cache is not None:
+        arr_tmp = jab_cache.convert(pack_rgb(df[from_cols].values))
+    else:
+        arr_tmp = cspace_convert(df[from_cols], from_cm, 'CAM02-UCS')
     df[['J', 'a', 'b']] = pd.DataFrame(arr_tmp, index=df.index)
 
     df.drop(columns=from_cols, inplace=True)
@@ -133,46 +548,399 @@ def find_cm_dists(df, max_diff=1.0):
                 then assume they correspond
         calculate a % of colormap accounted data,
                     % of data accounted for by colormap
+
+        All colormaps are matched at once with a single radius query against
+        `get_cmap_tree`, keeping the nearest entry of each colormap for each color
     """
+    cmap_tree = get_cmap_tree()
+    pct_cm, pct_page = find_cm_dists_pages(
+        df[['J', 'a', 'b']].values, np.zeros(df.shape[0], dtype=np.intp), 1, max_diff)
+    return make_cm_stats(cmap_tree.names, pct_cm[0], pct_page[0])
+
+def match_cm_colors(jab, max_diff=1.0):
+    """Nearest entry of each colormap within `max_diff` of each color
 
-    cm_stats = pd.DataFrame(index=cmap_knn.keys(),
-                            columns=['pct_cm', 'pct_page'])
-    cm_stats.index.name = 'cm'
+        Returns the (color, colormap, entry) indices of the matches
+    """
+    cmap_tree = get_cmap_tree()
+    n_colors = jab.shape[0]
 
-    for cm_name, cm_knn in cmap_knn.items():
-        dist, idx = cm_knn.kneighbors(df[['J', 'a', 'b']])
+    graph = cmap_tree.knn.radius_neighbors_graph(
+        jab, radius=max_diff, mode='distance')
+    color = np.repeat(np.arange(n_colors), np.diff(graph.indptr))
+    point = graph.indices
+    dist = graph.data
 
-        idx = idx[dist < max_diff]
-        dist = dist[dist < max_diff]
+    keep = dist < max_diff
+    color, point, dist = color[keep], point[keep], dist[keep]
+    cm = cmap_tree.label[point]
 
-        cm_colors = np.unique(idx)
+    # nearest colormap entry for each (color, colormap) pair
+    order = np.lexsort((point, dist, cm, color))
+    color, cm, point = color[order], cm[order], point[order]
+    first = np.ones(color.size, dtype=bool)
+    first[1:] = (color[1:] != color[:-1]) | (cm[1:] != cm[:-1])
+    color, cm, entry = color[first], cm[first], cmap_tree.entry[point[first]]
 
-        cm_stats.loc[cm_name, ['pct_cm', 'pct_page']] = [
-            cm_colors.size / 256,
-            idx.size / df.shape[0]
-        ]
+    for i, knn in cmap_tree.tie_knn.items():
+        sel = cm == i
+        if sel.any():
+            entry[sel] = knn.kneighbors(jab[color[sel]], return_distance=False)[:, 0]
 
-    cm_stats.sort_values('pct_cm', ascending=False, inplace=True)
+    return color, cm, entry
 
+def find_cm_dists_pages(jab, page, n_pages, max_diff=1.0):
+    """`find_cm_dists` for the colors of several pages at once, `page` being
+        the page number (0 to `n_pages` - 1) of each color
+
+        Returns `pct_cm` and `pct_page` as (page x colormap) arrays
+    """
+    cmap_tree = get_cmap_tree()
+    color, cm, entry = match_cm_colors(jab, max_diff)
+    return page_cm_stats(page[color], cm, entry,
+                         np.bincount(page, minlength=n_pages),
+                         len(cmap_tree.names), cmap_tree.n)
+
+def page_cm_stats(page, cm, entry, n_colors, n_cm, n):
+    """Reduces matches of page colors to colormap entries into `pct_cm`
+        (entries of each colormap used) and `pct_page` (colors of the page
+        matched) by page and colormap
+
+        `n_colors` is the number of colors on each page
+    """
+    n_pages = len(n_colors)
+    seg = page * n_cm + cm
+    used = np.zeros(n_pages * n_cm * n, dtype=bool)
+    used[seg * n + entry] = True
+    cm_colors = used.reshape(n_pages, n_cm, n).sum(axis=2)
+    matched = np.bincount(seg, minlength=n_pages * n_cm).reshape(n_pages, n_cm)
+    return cm_colors / 256, matched / n_colors[:, np.newaxis]
+
+
+def make_cm_stats(cmaps, pct_cm, pct_page):
+    """Assembles (and sorts) the per-colormap frame returned by `find_cm_dists`
+
+        Sorted by `pct_cm`, highest first, then by colormap name, so that
+        ties are listed the same way however the percentages were computed
+    """
+    cm_stats = pd.DataFrame({'pct_cm': pct_cm, 'pct_page': pct_page},
+                            index=pd.Index(cmaps, name='cm'),
+                            columns=['pct_cm', 'pct_page']).astype(object)
+    cm_stats.sort_values(['pct_cm', 'cm'], ascending=[False, True],
+                         kind='mergesort', inplace=True)
     return cm_stats
 
+def cm_stats_order(pct_cm, cmaps):
+    """Order of the rows that `make_cm_stats` sorts to
+    """
+    return np.lexsort((np.asarray(cmaps, dtype=str),
+                       -np.asarray(pct_cm, dtype=np.float64)))
+
+def make_cm_stats_pages(fns, cmaps, pct_cm, pct_page):
+    """`make_cm_stats` for several pages at once (rows of `pct_cm` and
+        `pct_page`), as the frame indexed by (fn, cm) that
+        `groupby('fn').apply(find_cm_dists)` gives
+    """
+    n_cm = len(cmaps)
+    order = np.concatenate([cm_stats_order(row, cmaps) for row in pct_cm])
+    order += np.repeat(np.arange(len(fns)) * n_cm, n_cm)
+    index = pd.MultiIndex.from_arrays(
+        [np.repeat(np.asarray(fns, dtype=object), n_cm),
+         np.tile(np.asarray(cmaps, dtype=object), len(fns))[order]],
+        names=['fn', 'cm'])
+    return pd.DataFrame({'pct_cm': pct_cm.ravel()[order].astype(object),
+                         'pct_page': pct_page.ravel()[order].astype(object)},
+                        index=index, columns=['pct_cm', 'pct_page'])
+
+CMAP_LUT_DIR = os.environ.get('CMAP_LUT_DIR')
+# bits per channel of the table (8 is exact, each bit less is 8x smaller)
+CMAP_LUT_BITS = int(os.environ.get('CMAP_LUT_BITS', 8))
+
+class CmapLUT(object):
+    """Precomputed nearest colormap entry for every color of the sRGB cube
+
+        For each (quantized) color and each colormap in `get_cmap_knn`, holds the
+        index of the nearest colormap entry (`idx`, uint8) and the distance
+        to it (`dist`, float16, `inf` if not within `max_diff`). Both are
+        memory-mapped from `path` so that workers share the pages.
+
+        With `bits` < 8, colors are binned into a (2**bits)**3 sub-cube and
+        looked up by the center of their bin.
+    """
+    def __init__(self, path, n=256, max_diff=1.0, bits=8):
+        self.path = path
+        self.n = n
+        self.max_diff = max_diff
+        self.bits = bits
+        with open(os.path.join(path, 'cmap_lut.json'), 'r') as fh:
+            self.version = json.load(fh)
+        self.cmaps = self.version['cmaps']
+        self.idx = np.load(os.path.join(path, 'cmap_lut_idx.npy'), mmap_mode='r')
+        self.dist = np.load(os.path.join(path, 'cmap_lut_dist.npy'), mmap_mode='r')
+
+    @staticmethod
+    def make_version(cmaps, n, max_diff, bits):
+        # the checksum, so that tables built from older samples aren't used
+        return dict(cmaps=list(cmaps), n=n, max_diff=max_diff, bits=bits,
+                    index=cmap_index_checksum(n))
+
+    def cells(self, packed):
+        """Row of the table for each 24-bit packed color
+        """
+        packed = np.asarray(packed, dtype=np.uint32)
+        if self.bits == 8:
+            return packed
+        shift = 8 - self.bits
+        r = (packed >> (16 + shift)) & ((1 << self.bits) - 1)
+        g = (packed >> (8 + shift)) & ((1 << self.bits) - 1)
+        b = (packed >> shift) & ((1 << self.bits) - 1)
+        return (r << (2 * self.bits)) | (g << self.bits) | b
+
+    def find_cm_dists(self, packed):
+        """Same as `find_cm_dists`, but from packed RGB colors and by lookup
+        """
+        packed = np.asarray(packed)
+        pct_cm, pct_page = self.find_cm_dists_pages(
+            packed, np.zeros(packed.size, dtype=np.intp), 1)
+        return make_cm_stats(self.cmaps, pct_cm[0], pct_page[0])
+
+    def find_cm_dists_pages(self, packed, page, n_pages):
+        """Same as `find_cm_dists_pages`, but from packed RGB colors and by lookup
+        """
+        rows = self.cells(packed)
+        # read the table in order
+        order = np.argsort(rows, kind='stable')
+        rows, page = rows[order], np.asarray(page)[order]
+        dist = np.asarray(self.dist[rows])
+        idx = np.asarray(self.idx[rows])
+
+        q, c = np.nonzero(np.isfinite(dist))
+        return page_cm_stats(page[q], c, idx[q, c],
+                             np.bincount(page, minlength=n_pages),
+                             len(self.cmaps), self.n)
+
+def cmap_lut_dir(path, version):
+    """Directory under `path` of the table for a `CmapLUT.make_version`
+    """
+    key = hashlib.sha1(json.dumps(version, sort_keys=True).encode('utf-8')).hexdigest()
+    return os.path.join(path, 'bits{}-{}'.format(version['bits'], key[:12]))
+
+def build_cmap_lut(path, n=256, max_diff=1.0, bits=CMAP_LUT_BITS, chunk=2**18):
+    """Fills the lookup table for `CmapLUT` by querying `get_cmap_knn`
+        in chunks of the (quantized) sRGB cube
+
+        The table is written to a temporary directory under `path` and
+        renamed into place once complete, so that workers never map a
+        partial (or another build's) table
+    """
+    cmap_knn = get_cmap_knn()
+    cmaps = list(cmap_knn.keys())
+    version = CmapLUT.make_version(cmaps, n, max_diff, bits)
+    final = cmap_lut_dir(path, version)
+    os.makedirs(path, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix='.build-', dir=path)
+
+    n_cells = 1 << (3 * bits)
+    idx = np.lib.format.open_memmap(os.path.join(tmp, 'cmap_lut_idx.npy'),
+        mode='w+', dtype=np.uint8, shape=(n_cells, len(cmaps)))
+    dist = np.lib.format.open_memmap(os.path.join(tmp, 'cmap_lut_dist.npy'),
+        mode='w+', dtype=np.float16, shape=(n_cells, len(cmaps)))
+
+    # centers of each bin along a channel
+    shift = 8 - bits
+    levels = (np.arange(1 << bits) << shift) + ((1 << shift) >> 1)
+    for start in range(0, n_cells, chunk):
+        cells = np.arange(start, min(start + chunk, n_cells))
+        rgb = np.stack([
+            levels[cells >> (2 * bits)],
+            levels[(cells >> bits) & ((1 << bits) - 1)],
+            levels[cells & ((1 << bits) - 1)]], axis=1)
+        jab = cspace_convert(rgb, 'sRGB255', 'CAM02-UCS')
+        for i, name in enumerate(cmaps):
+            d, j = cmap_knn[name].kneighbors(jab)
+            d = d[:, 0]
+            d[d >= max_diff] = np.inf
+            dist[cells, i] = d
+            idx[cells, i] = j[:, 0]
+
+    idx.flush()
+    dist.flush()
+    del idx, dist
+    with open(os.path.join(tmp, 'cmap_lut.json'), 'w') as fh:
+        json.dump(version, fh)
+
+    try:
+        os.replace(tmp, final)
+    except OSError:
+        # built concurrently by another worker, keep theirs
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return CmapLUT(final, n=n, max_diff=max_diff, bits=bits)
+
+def load_cmap_lut(path=CMAP_LUT_DIR, n=256, max_diff=1.0, bits=CMAP_LUT_BITS):
+    """Opens the lookup table under `path` for the current colormaps, `n`,
+        `max_diff` and `bits`, None if it hasn't been built (with
+        `python detect_cmap.py --build-lut`)
+    """
+    want = CmapLUT.make_version(get_cmap_knn().keys(), n, max_diff, bits)
+    lut_dir = cmap_lut_dir(path, want)
+    version_fn = os.path.join(lut_dir, 'cmap_lut.json')
+    if os.path.exists(version_fn):
+        with open(version_fn, 'r') as fh:
+            if json.load(fh) == want:
+                return CmapLUT(lut_dir, n=n, max_diff=max_diff, bits=bits)
+    print('No colormap lookup table in {}, matching by nearest neighbors'.format(path))
+    return None
+
+_cmap_lut = {}
+
+def get_cmap_lut(max_diff=1.0):
+    """The lookup table under `CMAP_LUT_DIR` for `max_diff`, if set and
+        built, opened once per process
+    """
+    if not CMAP_LUT_DIR:
+        return None
+    if max_diff not in _cmap_lut:
+        _cmap_lut[max_diff] = load_cmap_lut(CMAP_LUT_DIR, max_diff=max_diff)
+    return _cmap_lut[max_diff]
+
 rainbow_maps = ['prism', 'hsv', 'gist_rainbow',
                 'rainbow', 'nipy_spectral', 'gist_ncar', 'jet']
 
-def detect_rainbow_from_colors(df_colors, cm_thresh=0.5, debug=None):
+def jab_cells(jab, size=1.0, page=None):
+    """Integer key of the cell of a grid (with `size` wide cells over
+        CAM02-UCS) that each color falls in, distinct per `page` if given
+    """
+    cells = np.floor(np.asarray(jab) / size).astype(np.int64) + 2048
+    keys = (cells[..., 0] << 24) | (cells[..., 1] << 12) | cells[..., 2]
+    if page is not None:
+        keys |= np.asarray(page, dtype=np.int64) << 36
+    return keys
+
+def get_rainbow_cells(max_diff=1.0, slack=PREFILTER_SLACK):
+    """Keys of the cells within `slack` of each entry of each of
+        `rainbow_maps` (maps x entries x neighbors)
+    """
+    key = ('cells', max_diff, slack)
+    if key not in _cmap_index:
+        cmap_jab = get_cmap_jab()
+        steps = np.arange(-slack, slack + 1)
+        offsets = np.stack(np.meshgrid(steps, steps, steps, indexing='ij'), -1).reshape(-1, 3)
+        cells = np.array([np.floor(cmap_jab[name] / max_diff) for name in rainbow_maps])
+        _cmap_index[key] = jab_cells(
+            (cells[:, :, np.newaxis, :] + offsets + 0.5) * max_diff, max_diff)
+    return _cmap_index[key]
+
+def rainbow_bound(jab, page=None, n_pages=1, max_diff=1.0, slack=PREFILTER_SLACK):
+    """Upper bound on `pct_cm` of each of `rainbow_maps` (pages x maps) for
+        pages with the colors `jab` (`page` giving the page of each)
+
+        A colormap entry can only be matched by a color less than `max_diff`
+        away, i.e. in the same or a neighboring cell of a `max_diff` grid,
+        so with `slack` >= 1 entries without any page color in the cells
+        around them are out of reach. Lower `slack` skips more pages but
+        may miss some.
+    """
+    if page is None:
+        page = np.zeros(len(jab), dtype=np.int64)
+    page_cells = np.unique(jab_cells(jab, max_diff, page))
+
+    entries = get_rainbow_cells(max_diff, slack)
+    near = entries[np.newaxis] | (np.arange(n_pages, dtype=np.int64) << 36).reshape(-1, 1, 1, 1)
+    pos = np.minimum(np.searchsorted(page_cells, near), max(page_cells.size - 1, 0))
+    reachable = (page_cells[pos] == near).any(axis=3) if page_cells.size else \
+        np.zeros(near.shape[:3], dtype=bool)
+
+    bound = np.minimum(reachable.sum(axis=2),
+                       np.bincount(page, minlength=n_pages)[:, np.newaxis])
+    return bound / 256
+
+def could_be_rainbow(colors, cm_thresh=0.5, max_diff=1.0, slack=PREFILTER_SLACK):
+    """Whether a page with the packed `colors` could score above `cm_thresh`
+        for any of `rainbow_maps` (see `rainbow_bound`)
+    """
+    if jab_cache is not None:
+        jab = jab_cache.convert(colors)
+    else:
+        jab = cspace_convert(unpack_rgb(colors), 'sRGB255', 'CAM02-UCS')
+    return bool(rainbow_bound(jab, max_diff=max_diff, slack=slack).max() > cm_thresh)
+
+def prefilter_recall(hists, cm_thresh=0.5, slack=PREFILTER_SLACK):
+    """Checks the prefilter against full matching on `hists`
+
+        Returns the fraction of pages with a rainbow colormap above
+        `cm_thresh` that pass the prefilter (recall), and of all pages
+        with colors that it skips
+    """
+    n_rainbow = n_kept = n_skipped = n_pages = 0
+    for hist in hists:
+        if hist.size == 0:
+            continue
+        n_pages += 1
+        passed = could_be_rainbow(hist.colors, cm_thresh, slack=slack)
+        n_skipped += not passed
+        cm_stats = score_page(hist)
+        if (cm_stats.loc[rainbow_maps, 'pct_cm'] > cm_thresh).any():
+            n_rainbow += 1
+            n_kept += passed
+    return dict(recall=n_kept / n_rainbow if n_rainbow else 1.0,
+                skipped=n_skipped / n_pages if n_pages else 0.0,
+                pages=n_pages, rainbow_pages=n_rainbow)
+
+def detect_rainbow_from_colors(df_colors, cm_thresh=0.5, debug=None, lut=None,
+                               prefilter=False, max_diff=1.0):
     """Returns a tuple of pages determined to have rainbow and
     results of colormap detection
+
+    If a `CmapLUT` is given, colors are matched by table lookup instead
+    of nearest neighbor queries
+
+    With `prefilter`, pages that can't reach `cm_thresh` for any rainbow
+    colormap (`rainbow_bound`) aren't matched, or reported, at all
     """
     # Write out RGB colors found
     if isinstance(debug, str):
         df_colors.to_csv(debug + '_colors.csv', index=False)
 
-    # Find nearest color for each page
-    df_colors = convert_to_jab(df_colors)
-    df_cmap = df_colors.groupby('fn').apply(find_cm_dists)
+    if prefilter:
+        page, fns = pd.factorize(df_colors['fn'], sort=True)
+        if jab_cache is not None:
+            jab = jab_cache.convert(pack_rgb(df_colors[['R', 'G', 'B']].values))
+        else:
+            jab = cspace_convert(df_colors[['R', 'G', 'B']].values, 'sRGB255', 'CAM02-UCS')
+        bound = rainbow_bound(jab, page, len(fns), max_diff)
+        keep = bound.max(axis=1) > cm_thresh
+        metrics.count('pages_prefiltered', int((~keep).sum()))
+        df_colors = df_colors[keep[page]]
+        if df_colors.empty:
+            return [], pd.DataFrame(columns=['pct_cm', 'pct_page'],
+                index=pd.MultiIndex.from_tuples([], names=['fn', 'cm']))
+
+    # Find nearest color for each page, all pages at once
+    page, fns = pd.factorize(df_colors['fn'], sort=True)
+    metrics.count('pages_scored', len(fns))
+    if lut is None:
+        with metrics.timer('colorspace'):
+            df_colors = convert_to_jab(df_colors)
+        with metrics.timer('knn'):
+            pct_cm, pct_page = find_cm_dists_pages(
+                df_colors[['J', 'a', 'b']].values, page, len(fns), max_diff)
+        cmaps = get_cmap_tree().names
+    else:
+        with metrics.timer('lut'):
+            pct_cm, pct_page = lut.find_cm_dists_pages(
+                pack_rgb(df_colors[['R', 'G', 'B']].values), page, len(fns))
+        cmaps = lut.cmaps
+    df_cmap = make_cm_stats_pages(fns, cmaps, pct_cm, pct_page)
     if isinstance(debug, str):
         df_cmap.to_csv(debug + '_cm.csv')
 
+    return find_rainbow_pages(df_cmap, cm_thresh)
+
+def find_rainbow_pages(df_cmap, cm_thresh=0.5):
+    """Returns a tuple of pages with a rainbow colormap above `cm_thresh`
+    and the colormaps above `cm_thresh` on each page
+    """
     df_cmap = df_cmap[df_cmap['pct_cm'] > cm_thresh]
     df_rainbow = df_cmap[df_cmap.index.get_level_values('cm').isin(rainbow_maps)]
     if df_rainbow.size == 0:
@@ -185,14 +953,589 @@ def detect_rainbow_from_colors(df_colors, cm_thresh=0.5, debug=None):
 
     return pgs_w_rainbow.tolist(), df_cmap
 
-def detect_rainbow_from_iiif(paper_id, pages, debug=False):
-    """Pull images from iiif server
+def score_page(hist, lut=None, max_diff=1.0):
+    """Colormap matches (`find_cm_dists`) for the colors of a `ColorHist`
+    """
+    metrics.count('pages_scored')
+    if lut is not None:
+        with metrics.timer('lut'):
+            return lut.find_cm_dists(hist.colors)
+    with metrics.timer('colorspace'):
+        if jab_cache is not None:
+            jab = jab_cache.convert(hist.colors)
+        else:
+            jab = cspace_convert(unpack_rgb(hist.colors), 'sRGB255', 'CAM02-UCS')
+    with metrics.timer('knn'):
+        return find_cm_dists(pd.DataFrame(jab, columns=['J', 'a', 'b']), max_diff)
+
+def near_thresh(cm_stats, cm_thresh=0.5, margin=IIIF_REFINE_MARGIN):
+    """Whether the best rainbow colormap on a page is within `margin`
+    of being called the other way
+    """
+    pct_cm = cm_stats.loc[cm_stats.index.isin(rainbow_maps), 'pct_cm']
+    return abs(pct_cm.max() - cm_thresh) <= margin
+
+def detect_rainbow_from_hists(hists, cm_thresh=0.5, triage=None, lut=None,
+                              refine=None, refine_margin=IIIF_REFINE_MARGIN,
+                              cache=None, max_diff=1.0, prefilter=False):
+    """Same as `detect_rainbow_from_colors`, but scores each page as soon as
+    it is available from `hists` (an iterable of `ColorHist`) so that only
+    the colormaps found, not the colors, are held for the whole paper
+
+    With `triage`, stops consuming `hists` once that many pages with a
+    rainbow colormap have been found
+
+    With `refine`, pages that are `near_thresh` are set aside and scored
+    again, once `hists` is exhausted, from `refine(names)` (an iterable of
+    `ColorHist`, e.g. the same pages at a higher resolution)
+
+    `hists` may also yield `PageResult`s from the page `cache`, in which
+    newly scored pages are stored
+
+    With `prefilter`, pages that can't reach `cm_thresh` (less
+    `refine_margin` if refining) for any rainbow colormap aren't scored
+    """
+    borderline = []
+    floor = cm_thresh - refine_margin if refine is not None else cm_thresh
+
+    def scored(hists, check):
+        for hist in hists:
+            if isinstance(hist, PageResult):
+                cm_stats = hist.cm_stats
+            elif prefilter and hist.size > 0 and \
+                    not could_be_rainbow(hist.colors, floor, max_diff):
+                metrics.count('pages_prefiltered')
+                continue
+            else:
+                cm_stats = score_page(hist, lut, max_diff) if hist.size > 0 else None
+                if cache is not None and hist.key is not None:
+                    cache.put(hist.key, dump_cm_stats(cm_stats))
+            if cm_stats is None:
+                continue
+            if check and near_thresh(cm_stats, cm_thresh, refine_margin):
+                borderline.append(hist.name)
+                continue
+            yield hist.name, cm_stats[cm_stats['pct_cm'] > cm_thresh]
+
+    def refined():
+        if borderline:
+            for page in scored(refine(borderline), False):
+                yield page
+
+    pages = scored(hists, refine is not None)
+    if refine is not None:
+        pages = itertools.chain(pages, refined())
+
+    found = {}
+    n_rainbow = 0
+    for name, cm_stats in pages:
+        found[name] = cm_stats
+        if found[name].index.isin(rainbow_maps).any():
+            n_rainbow += 1
+            if triage and n_rainbow >= triage:
+                break
+
+    if not found:
+        return [], pd.DataFrame(columns=['pct_cm', 'pct_page'],
+            index=pd.MultiIndex.from_tuples([], names=['fn', 'cm']))
+
+    # same page order as from a groupby
+    names = sorted(found.keys())
+    df_cmap = pd.concat([found[n] for n in names], keys=names, names=['fn'])
+    return find_rainbow_pages(df_cmap, cm_thresh)
+
+def fetch_page(url, timeout=IIIF_TIMEOUT, retries=IIIF_RETRIES):
+    """Downloads the bytes of a page (see `http_client`), retrying with
+        backoff on connection errors and server errors
+    """
+    with metrics.timer('fetch'):
+        data = http_client.get(url, timeout=timeout, retries=retries)
+    metrics.count('pages_fetched')
+    metrics.count('bytes_fetched', len(data))
+    return data
+
+def decode_hist(data, name, key=None):
+    """Decodes image bytes into a `ColorHist`
+    """
+    with metrics.timer('decode'):
+        im = skimage.io.imread(io.BytesIO(data))
+    return color_hist(im, name)._replace(key=key)
+
+PAGE_CACHE = os.environ.get('PAGE_CACHE', '')
+PAGE_CACHE_MAX_BYTES = int(os.environ.get('PAGE_CACHE_MAX_BYTES', 2**30))
+# bump when scoring changes in a way that the colormaps, `n` and `max_diff`
+# don't capture, to invalidate cached page results
+DETECTOR_VERSION = 1
+
+HIST_STORE = os.environ.get('HIST_STORE', '')
+
+_hist_store = {}
+
+def get_hist_store():
+    """The `hist_store.HistStore` in the directory `HIST_STORE`, if set
+    """
+    if not HIST_STORE:
+        return None
+    if 'store' not in _hist_store:
+        import hist_store
+        _hist_store['store'] = hist_store.HistStore(HIST_STORE)
+    return _hist_store['store']
+
+PageResult = collections.namedtuple('PageResult', ['name', 'key', 'cm_stats'])
+
+_page_cache = {}
+
+def get_page_cache():
+    """The cache of page results configured by `PAGE_CACHE` (a directory or
+        a redis url), if any
+    """
+    if not PAGE_CACHE:
+        return None
+    if 'cache' not in _page_cache:
+        import cache
+        _page_cache['cache'] = cache.open_cache(PAGE_CACHE, PAGE_CACHE_MAX_BYTES,
+                                                prefix='jetfighter:pages:')
+    return _page_cache['cache']
+
+def detector_version(max_diff=1.0, lut=None):
+    """Identifies the settings that page results depend on: colormaps,
+        `max_diff` and the lookup table (`CmapLUT`) pages are matched with,
+        if any
+    """
+    tree = get_cmap_tree()
+    key = [DETECTOR_VERSION, tree.names, tree.n, max_diff, cmap_index_checksum(tree.n),
+           lut.version if lut is not None else None]
+    return hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()[:16]
+
+def page_key(data, version):
+    """Content address of a page image for a detector version
+    """
+    return '{}-{}'.format(hashlib.sha256(data).hexdigest(), version)
+
+def dump_cm_stats(cm_stats):
+    """Packs the `find_cm_dists` result of a page (or None for a page
+        without colors) for the page cache
+    """
+    if cm_stats is None:
+        return b''
+    names = get_cmap_tree().names
+    return np.concatenate([cm_stats['pct_cm'].reindex(names).values,
+                           cm_stats['pct_page'].reindex(names).values]
+                          ).astype(np.float64).tobytes()
+
+def load_cm_stats(data):
+    if not data:
+        return None
+    names = get_cmap_tree().names
+    pct = np.frombuffer(data, dtype=np.float64)
+    return make_cm_stats(names, pct[:len(names)], pct[len(names):])
+
+def fetch_cached(url, name, cache=None, version=None, timeout=IIIF_TIMEOUT,
+                 retries=IIIF_RETRIES):
+    """Retrieves a page, returning its `PageResult` if already in `cache`
+        or otherwise its bytes and cache key
+    """
+    data = fetch_page(url, timeout, retries)
+    if cache is None:
+        return data, None
+    key = page_key(data, version)
+    cached = cache.get(key)
+    if cached is not None:
+        metrics.count('page_cache_hits')
+        return PageResult(name, key, load_cm_stats(cached))
+    return data, key
+
+def iter_hists(urls, names, fetch_workers=IIIF_FETCH_WORKERS,
+               decode_workers=IIIF_DECODE_WORKERS, timeout=IIIF_TIMEOUT,
+               retries=IIIF_RETRIES, cache=None, version=None):
+    """Fetches pages on a pool of threads while decoding and counting colors
+        of already retrieved pages on a pool of processes
+
+        Yields a `ColorHist` per url as each becomes available. Pages not yet
+        retrieved are abandoned if the generator is closed early.
+
+        With a page `cache`, pages whose image has already been scored
+        (with the settings of `version`, see `detector_version`) are
+        yielded as `PageResult`s instead, without decoding them
     """
-    url = "https://{}/iiif/2/biorxiv:{}.pdf/full/full/0/default.png?page={}"
-    data = [parse_img(url.format(IIIF_HOST, paper_id, pg), str(pg)) for pg in range(1, pages+1)]
+    if cache is not None and version is None:
+        raise ValueError("A page cache needs the detector version pages are scored with")
+
+    def fetch_decode(url, name):
+        result = fetch_cached(url, name, cache, version, timeout, retries)
+        if isinstance(result, PageResult):
+            return result
+        return decode_hist(result[0], name, result[1])
+
+    def fetch(url, name):
+        return fetch_cached(url, name, cache, version, timeout, retries)
+
+    # allow for every retry of a page before giving up on waiting
+    wait_timeout = timeout * (retries + 1)
+
+    decode_pool = None
+    if decode_workers > 0:
+        decode_pool = concurrent.futures.ProcessPoolExecutor(decode_workers)
+        # start (fork) the workers now, not once fetch threads are mid-request
+        concurrent.futures.wait([decode_pool.submit(int) for _ in range(decode_workers)])
+
+    pending = {}
+    # decoded in another process, along with their metrics
+    decoding = set()
+    with concurrent.futures.ThreadPoolExecutor(fetch_workers) as fetch_pool:
+        try:
+            for url, name in zip(urls, names):
+                if decode_pool is None:
+                    pending[fetch_pool.submit(fetch_decode, url, name)] = name
+                else:
+                    pending[fetch_pool.submit(fetch, url, name)] = name
+
+            while pending:
+                done, _ = concurrent.futures.wait(pending, timeout=wait_timeout,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                if not done:
+                    raise concurrent.futures.TimeoutError(
+                        "No page retrieved in {} seconds".format(wait_timeout))
+                for f in done:
+                    name = pending.pop(f)
+                    result = f.result()
+                    if f in decoding:
+                        decoding.discard(f)
+                        result, reported = result
+                        metrics.merge(reported)
+                    if isinstance(result, (ColorHist, PageResult)):
+                        yield result
+                    else:
+                        data, key = result
+                        f = decode_pool.submit(metrics.collect, decode_hist, data, name, key)
+                        decoding.add(f)
+                        pending[f] = name
+        finally:
+            for f in pending:
+                f.cancel()
+            if decode_pool is not None:
+                decode_pool.shutdown()
+
+def fetch_hists(urls, names, **kwargs):
+    """Returns a `ColorHist` per url, in order (see `iter_hists`)
+    """
+    order = {name: i for i, name in enumerate(names)}
+    return sorted(iter_hists(urls, names, **kwargs), key=lambda h: order[h.name])
+
+class IIIFSource(object):
+    """Pages of a biorxiv paper, rendered by the IIIF server at `size`
+    """
+    url = "https://{}/iiif/2/biorxiv:{}.pdf/full/{}/0/default.png?page={}"
+
+    def __init__(self, paper_id, pages, size=IIIF_SIZE, mode=IIIF_FETCH_MODE,
+                 host=IIIF_HOST, cache=None, version=None, store=None):
+        if cache is not None and version is None:
+            raise ValueError("A page cache needs the detector version pages are scored with")
+        self.paper_id = paper_id
+        self.pages = pages
+        self.size = size
+        self.mode = mode
+        self.host = host
+        self.cache = cache
+        self.version = version
+        self.store = store
+
+    def names(self):
+        return [str(pg) for pg in range(1, self.pages+1)]
+
+    def hists(self, names=None):
+        """`ColorHist` of each page (all if `names` is None), in no
+            particular order, recorded in `store` if given
+        """
+        if names is None:
+            names = self.names()
+        urls = [self.url.format(self.host, self.paper_id, self.size, n) for n in names]
+        if self.mode == 'serial':
+            hists = self._iter_serial(urls, names)
+        else:
+            hists = iter_hists(urls, names, cache=self.cache, version=self.version)
+        if self.store is not None:
+            hists = self.store.recording(self.paper_id, hists)
+        return hists
+
+    def _iter_serial(self, urls, names):
+        for url, name in zip(urls, names):
+            result = fetch_cached(url, name, self.cache, self.version)
+            if isinstance(result, PageResult):
+                yield result
+            else:
+                yield decode_hist(result[0], name, result[1])
+
+class PDFSource(object):
+    """Pages of a local pdf, rendered in-process at `dpi` (requires PyMuPDF)
+
+        Pages are named by number, prefixed with `prefix-` if given
+
+        With `extract`, pages are inspected before rendering anything:
+        pages with neither images nor colored vector graphics are skipped,
+        embedded images are read directly when they are the only color on
+        the page and only pages with colored vector content are rendered.
+        `report` counts how each page was handled.
+    """
+    def __init__(self, fn, dpi=PDF_DPI, prefix=None, extract=PDF_EXTRACT):
+        self.fn = fn
+        self.dpi = dpi
+        self.prefix = prefix
+        self.extract = extract
+        self.report = collections.Counter()
+
+    def names(self):
+        with fitz.open(self.fn) as doc:
+            n_pages = len(doc)
+        if self.prefix is None:
+            return [str(pg) for pg in range(1, n_pages+1)]
+        return ['{}-{}'.format(self.prefix, pg) for pg in range(1, n_pages+1)]
+
+    def render(self, page, clip=None):
+        """Renders a PyMuPDF page straight into an RGB array
+        """
+        zoom = self.dpi / 72
+        with metrics.timer('render'):
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False,
+                                  colorspace=fitz.csRGB, clip=clip)
+        return np.frombuffer(pix.samples, dtype=np.uint8).reshape(
+            pix.height, pix.width, pix.n)
+
+    def hists(self, names=None):
+        if names is None:
+            names = self.names()
+        with fitz.open(self.fn) as doc:
+            for name in names:
+                page = doc[int(name.rsplit('-', 1)[-1]) - 1]
+                if self.extract:
+                    yield self.extract_hist(doc, page, name)
+                else:
+                    yield color_hist(self.render(page), name)
+
+    def extract_hist(self, doc, page, name):
+        """`ColorHist` of a page from its embedded images, falling back
+            to rendering the page if it has colored vector content or if
+            the images can't be read
+        """
+        images = set(img[0] for img in page.get_images(full=True))
+        if uses_shading(doc, page) or any(
+                is_chromatic(d.get('color')) or is_chromatic(d.get('fill'))
+                for d in page.get_drawings()):
+            self.report['rendered (vector color)'] += 1
+            return color_hist(self.render(page), name)
+
+        if not images:
+            self.report['skipped (no images or vector color)'] += 1
+            return color_hist(np.empty((0, 0)), name)
+
+        try:
+            hist = merge_hists([color_hist(image_array(doc, xref), name)
+                                for xref in images], name)
+        except Exception:
+            self.report['rendered (extraction failed)'] += 1
+            return color_hist(self.render(page), name)
+
+        if hist.size == 0:
+            self.report['skipped (grayscale images)'] += 1
+        else:
+            self.report['extracted images'] += 1
+        return hist
+
+def is_chromatic(rgb, tol=0.02):
+    """Whether a PyMuPDF color (floats in [0, 1]) is not a shade of gray
+    """
+    return rgb is not None and len(rgb) == 3 and max(rgb) - min(rgb) > tol
+
+def uses_shading(doc, page):
+    """Whether the resources of a page (or of its forms) include smooth
+        shadings or patterns, which aren't listed as drawings
+    """
+    xrefs = [page.xref] + [xo[0] for xo in page.get_xobjects()]
+    for xref in xrefs:
+        kind, res = doc.xref_get_key(xref, 'Resources')
+        if kind == 'xref':
+            res = doc.xref_object(int(res.split()[0]))
+        elif kind == 'null' and xref == page.xref:
+            # inherited resources, can't tell
+            return True
+        if '/Shading' in res or '/Pattern' in res:
+            return True
+    return False
+
+def image_array(doc, xref):
+    """Reads an embedded image into an array, converted to RGB unless
+        it is grayscale
+    """
+    pix = fitz.Pixmap(doc, xref)
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)
+    if pix.n not in (1, 3):
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    return np.frombuffer(pix.samples, dtype=np.uint8).reshape(
+        pix.height, pix.width, pix.n)
+
+class ImageSource(object):
+    """Pages that are already images (paths or urls), named by file name
+    """
+    def __init__(self, fns):
+        self.fns = collections.OrderedDict(
+            (os.path.splitext(os.path.basename(fn))[0], fn) for fn in fns)
+
+    def names(self):
+        return list(self.fns.keys())
+
+    def hists(self, names=None):
+        if names is None:
+            names = self.names()
+        return (parse_hist(self.fns[n], n) for n in names)
+
+def detect_rainbow_from_source(source, stream=True, triage=DETECT_TRIAGE,
+                               refine=None, refine_margin=IIIF_REFINE_MARGIN,
+                               cache=None, prefilter=DETECT_PREFILTER, max_diff=1.0):
+    """Detects rainbow colormaps in the pages from `source`
+        (`IIIFSource`, `PDFSource`, `ImageSource`)
+
+    With `stream`, each page is scored as soon as it has been parsed and
+    its colors discarded. `triage` (streaming only) stops retrieving pages
+    once that many have been found with a rainbow colormap.
+
+    With `refine`, another source for the same pages (streaming only),
+    pages whose score is within `refine_margin` of the threshold are
+    retrieved and scored again from it.
+
+    Pages scored are stored in the page `cache` (streaming only), which
+    should be the one given to the sources, along with the
+    `detector_version` of `max_diff` and `get_cmap_lut(max_diff)`.
+
+    With `prefilter`, pages whose colors rule out every rainbow colormap
+    (see `rainbow_bound`) are not matched, so their other colormaps aren't
+    reported either.
+    """
+    hists = source.hists()
+
+    lut = get_cmap_lut(max_diff)
+
+    if stream:
+        try:
+            return detect_rainbow_from_hists(hists, triage=triage, lut=lut,
+                refine=refine.hists if refine is not None else None,
+                refine_margin=refine_margin, cache=cache, max_diff=max_diff,
+                prefilter=prefilter)
+        finally:
+            hists.close()
+
+    data = [h.to_frame() for h in hists]
     df = pd.concat(data, ignore_index=True, copy=False)
-    return detect_rainbow_from_colors(df)
+    return detect_rainbow_from_colors(df, lut=lut, prefilter=prefilter,
+                                      max_diff=max_diff)
+
+def detect_rainbow_from_iiif(paper_id, pages, debug=False, mode=IIIF_FETCH_MODE,
+                             stream=True, triage=DETECT_TRIAGE, size=IIIF_SIZE,
+                             refine_size=IIIF_REFINE_SIZE,
+                             refine_margin=IIIF_REFINE_MARGIN,
+                             prefilter=DETECT_PREFILTER, max_diff=1.0):
+    """Pull images from iiif server
 
+    Pages are rendered at the IIIF `size`. With `refine_size`, pages whose
+    score is within `refine_margin` of the threshold are retrieved and
+    scored again at that size. See `detect_rainbow_from_source`.
+
+    Page histograms are kept in `HIST_STORE`, if set, for `rescore_paper`.
+    """
+    cache = get_page_cache() if stream else None
+    version = None
+    if cache is not None:
+        version = detector_version(max_diff, get_cmap_lut(max_diff))
+    store = get_hist_store()
+    source = IIIFSource(paper_id, pages, size=size, mode=mode, cache=cache,
+                        version=version, store=store)
+    refine = None
+    if refine_size and refine_size != size:
+        refine = IIIFSource(paper_id, pages, size=refine_size, mode=mode,
+                            cache=cache, version=version, store=store)
+    return detect_rainbow_from_source(source, stream=stream, triage=triage,
+                                      refine=refine, refine_margin=refine_margin,
+                                      cache=cache, prefilter=prefilter,
+                                      max_diff=max_diff)
+
+def rescore_paper(paper_id, store, cm_thresh=0.5, max_diff=1.0, page_count=None):
+    """Detection for a paper from the histograms in `store` alone
+
+        Returns the paper id along with the result, for use from a pool.
+        With `page_count`, the result is None unless every page is stored.
+    """
+    if page_count is not None and not store.covers(paper_id, page_count):
+        return paper_id, None
+    hists = store.load(paper_id)
+    return paper_id, detect_rainbow_from_hists(hists, cm_thresh=cm_thresh,
+                                               max_diff=max_diff)
+
+def detect_rainbow_from_pdf(fn, dpi=PDF_DPI, extract=PDF_EXTRACT, **kwargs):
+    """Renders a local pdf instead of going through the iiif server
+    (see `PDFSource` for `extract`)
+    """
+    return detect_rainbow_from_source(PDFSource(fn, dpi=dpi, extract=extract),
+                                      **kwargs)
+
+
+def resize_iiif(im, size):
+    """Resizes a PIL image as a IIIF server would for `size`
+        ('full', 'max', 'pct:n', 'w,', ',h', 'w,h' or '!w,h')
+    """
+    w, h = im.size
+    if size in ('full', 'max'):
+        return im
+    if size.startswith('pct:'):
+        scale = float(size[4:]) / 100
+        new = (w * scale, h * scale)
+    else:
+        bound = size.startswith('!')
+        sw, sh = size.lstrip('!').split(',')
+        if bound:
+            scale = min(int(sw) / w, int(sh) / h)
+            new = (w * scale, h * scale)
+        elif not sh:
+            new = (int(sw), h * int(sw) / w)
+        elif not sw:
+            new = (w * int(sh) / h, int(sh))
+        else:
+            new = (int(sw), int(sh))
+    new = tuple(max(1, int(round(x))) for x in new)
+    return im.resize(new, Image.LANCZOS)
+
+def compare_resolutions(fns, size='!800,800', cm_thresh=0.5,
+                        refine_margin=IIIF_REFINE_MARGIN):
+    """Compares detection on `fns` (full resolution renders) against
+        renders downscaled to `size`, alone and with borderline pages
+        refined at full resolution
+
+        Returns a dataframe per page with the best rainbow colormap score
+        at each resolution and whether each approach detects a rainbow
+    """
+    rows = []
+    for fn in fns:
+        im = Image.open(fn)
+        full = color_hist(im, fn)
+        low = color_hist(resize_iiif(im, size), fn)
+        if full.size == 0 or low.size == 0:
+            continue
+        full_stats = score_page(full)
+        low_stats = score_page(low)
+        refined = near_thresh(low_stats, cm_thresh, refine_margin)
+        full_score = full_stats.loc[full_stats.index.isin(rainbow_maps), 'pct_cm'].max()
+        low_score = low_stats.loc[low_stats.index.isin(rainbow_maps), 'pct_cm'].max()
+        rows.append(dict(fn=fn, full_score=full_score, low_score=low_score,
+            full=full_score > cm_thresh, low=low_score > cm_thresh,
+            refined=refined,
+            two_pass=full_score > cm_thresh if refined else low_score > cm_thresh))
+    return pd.DataFrame(rows, columns=['fn', 'full_score', 'low_score', 'full',
+                                       'low', 'refined', 'two_pass'])
+
+def test_compare_resolutions():
+    fns = sorted(glob.glob("test/172627-0*"))
+    df = compare_resolutions(fns, '!400,400')
+    assert (df['two_pass'] == df['full']).all()
+    assert not df['refined'].all()
 
 def test_detect_rainbow_from_iiif():
     # actually 37 pages, but it takes a long time, just test through 10
@@ -204,6 +1547,165 @@ def test_detect_rainbow_from_iiif():
     else:
         print("FYI, the jet image on page 1 isn't detected")
 
+def test_color_hist():
+    """Alternate encodings of the same page should give the same histogram
+    """
+    im = skimage.io.imread("test/172627-004.jpg")
+    hist = color_hist(im, '4')
+    assert hist.size > 0
+    assert not np.isin([0, 0xFFFFFF], hist.colors).any()
+
+    rgba = np.dstack([im, np.full(im.shape[:2], 255, dtype=np.uint8)])
+    assert np.array_equal(color_hist(rgba, '4').counts, hist.counts)
+    assert np.array_equal(color_hist(im.astype(np.uint16) * 257, '4').colors,
+                          hist.colors)
+    assert color_hist(im[..., 0], '4').size == 0
+
+    df = hist.to_frame()
+    assert np.array_equal(pack_rgb(df[['R', 'G', 'B']].values), hist.colors)
+
+def test_rainbow_bound():
+    """The prefilter bound holds on the fixtures, skips pages without
+    rainbow colormaps and leaves detection as is
+    """
+    hists = [parse_hist(fn) for fn in sorted(glob.glob("test/172627-0*"))]
+    for hist in hists:
+        if hist.size == 0:
+            continue
+        bound = rainbow_bound(jab_cache.convert(hist.colors))[0]
+        pct_cm = score_page(hist).loc[rainbow_maps, 'pct_cm'].values
+        assert (pct_cm <= bound).all()
+
+    check = prefilter_recall(hists)
+    assert check['recall'] == 1.0
+    assert check['skipped'] > 0.5
+    assert detect_rainbow_from_hists(hists, prefilter=True)[0] == [4, 12, 14, 16]
+
+    # every page filtered out, without streaming as well
+    df = parse_img('test/172627-000.png')
+    pgs, df_cmap = detect_rainbow_from_colors(df, prefilter=True)
+    assert pgs == [] and df_cmap.empty
+    assert df_cmap.index.names == ['fn', 'cm']
+    source = ImageSource(['test/172627-000.png'])
+    assert detect_rainbow_from_source(source, stream=False, prefilter=True)[0] == []
+
+def test_color_hist_strips():
+    """Counting in strips gives the same histogram as the whole image
+    """
+    rgba = np.random.RandomState(0).randint(0, 256, (500, 300, 4)).astype(np.uint8)
+    for im in [skimage.io.imread("test/172627-004.jpg"),
+               Image.open("test/172627-012.png"), rgba]:
+        whole = color_hist(im, 'x', budget=0)
+        strips = color_hist(im, 'x', budget=100000)
+        assert np.array_equal(whole.colors, strips.colors)
+        assert np.array_equal(whole.counts, strips.counts)
+
+def test_jab_cache():
+    """Cached conversions, including after eviction, match direct ones
+    """
+    packed = np.random.RandomState(0).randint(0, 1 << 24, 500).astype(np.uint32)
+    expected = cspace_convert(unpack_rgb(packed), 'sRGB255', 'CAM02-UCS')
+
+    cache = JabCache(maxsize=300)
+    for sl in [slice(None, 400), slice(100, None), slice(None)]:
+        assert np.array_equal(cache.convert(packed[sl]), expected[sl])
+    assert len(cache) == 300
+    assert cache.stats()['hits'] > 0
+
+def test_jab_cache_files(tmpdir):
+    """Tables left incomplete (e.g. by an interrupted first run) are recreated
+    """
+    path = str(tmpdir.join('jab'))
+    packed = np.arange(0, 1 << 24, 1 << 16, dtype=np.uint32)
+    JabCache(path=path).convert(packed)
+
+    os.remove(path + '.filled.npy')
+    cache = JabCache(path=path)
+    assert not cache.filled.any()
+    assert np.array_equal(cache.convert(packed),
+                          cspace_convert(unpack_rgb(packed), 'sRGB255', 'CAM02-UCS'))
+    assert sorted(os.listdir(str(tmpdir))) == ['jab.filled.npy', 'jab.values.npy']
+
+def test_cmap_lut(tmpdir):
+    path = str(tmpdir)
+    assert load_cmap_lut(path, bits=4) is None
+    lut = build_cmap_lut(path, bits=4)
+    assert load_cmap_lut(path, bits=4).path == lut.path
+    assert load_cmap_lut(path, bits=5) is None
+    # nor one built from other colormap samples
+    assert lut.version['index'] == cmap_index_checksum(lut.n)
+    version_fn = os.path.join(lut.path, 'cmap_lut.json')
+    with open(version_fn, 'w') as fh:
+        json.dump(dict(lut.version, index='stale'), fh)
+    assert load_cmap_lut(path, bits=4) is None
+    with open(version_fn, 'w') as fh:
+        json.dump(lut.version, fh)
+    assert [fn for fn in os.listdir(path) if fn.startswith('.build-')] == []
+
+    # colors at the centers of the table's bins, with fixture pages' counts
+    rs = np.random.RandomState(0)
+    for fn in ['test/172627-004.jpg', 'test/172627-012.png']:
+        hist = parse_hist(fn)
+        colors = np.unique(pack_rgb(((unpack_rgb(hist.colors) >> 4) << 4) + 8))
+        hist = ColorHist(hist.name, colors, rs.randint(1, 100, colors.size))
+        pd.testing.assert_frame_equal(score_page(hist, lut), score_page(hist))
+
+def test_make_cm_stats_ties():
+    """Ties are listed by colormap name, in both the single and batched paths
+    """
+    cmaps = ['jet', 'hsv', 'viridis', 'gray']
+    pct_cm = np.array([[0.25, 0.25, 0.5, 0.0]])
+    single = make_cm_stats(cmaps, pct_cm[0], pct_cm[0])
+    assert single.index.tolist() == ['viridis', 'hsv', 'jet', 'gray']
+    batched = make_cm_stats_pages(['p'], cmaps, pct_cm, pct_cm)
+    assert batched.index.get_level_values('cm').tolist() == single.index.tolist()
+
+def test_find_cm_dists_pages():
+    """Batched scoring matches scoring page by page
+    """
+    fns = sorted(glob.glob("test/172627-0*"))[:6]
+    df = convert_to_jab(pd.concat([parse_img(fn) for fn in fns], ignore_index=True))
+    page, names = pd.factorize(df['fn'], sort=True)
+    batched = make_cm_stats_pages(names, get_cmap_tree().names,
+        *find_cm_dists_pages(df[['J', 'a', 'b']].values, page, len(names)))
+    pd.testing.assert_frame_equal(batched, df.groupby('fn').apply(find_cm_dists))
+
+def test_page_cache(tmpdir):
+    """Page results read back from the cache match freshly scored ones
+    """
+    import pytest
+    import cache
+    pc = cache.DiskCache(str(tmpdir))
+    with open("test/172627-004.jpg", 'rb') as fh:
+        data = fh.read()
+    key = page_key(data, detector_version())
+
+    expected = score_page(decode_hist(data, '004', key))
+    pc.put(key, dump_cm_stats(expected))
+    pd.testing.assert_frame_equal(load_cm_stats(pc.get(key)), expected)
+    assert load_cm_stats(dump_cm_stats(None)) is None
+
+    # results from other settings aren't reused
+    lut = build_cmap_lut(str(tmpdir.mkdir('lut')), bits=4)
+    versions = {detector_version(), detector_version(0.5), detector_version(lut=lut)}
+    assert len(versions) == 3
+    with pytest.raises(ValueError):
+        IIIFSource('172627v1', 10, cache=pc)
+
+def test_detect_rainbow_from_pdf():
+    """Renders pdf pages locally, without the iiif server
+    """
+    import pytest
+    if fitz is None:
+        pytest.skip("PyMuPDF is not installed")
+    pgs, _ = detect_rainbow_from_pdf("test/172627_short.pdf")
+    assert 3 in pgs
+
+    source = PDFSource("test/172627.full.pdf", extract=True)
+    pgs, _ = detect_rainbow_from_source(source)
+    assert sorted(pgs) == [9, 28, 29, 30]
+    assert source.report['extracted images'] == 10
+
 def test_detect_cmap():
     """Tests using local files incase theres an issue with the iiif-server
     """
@@ -216,13 +1718,63 @@ def test_detect_cmap():
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('images', nargs='+')
+    parser.add_argument('images', nargs='*', help="images and/or pdfs")
+    parser.add_argument('--dpi', type=int, default=PDF_DPI,
+                        help="resolution to render pdfs at")
+    parser.add_argument('--extract', action='store_true', default=PDF_EXTRACT,
+                        help="read images embedded in pdfs and skip pages "
+                             "without color instead of rendering every page")
+    parser.add_argument('--rebuild-index', action='store_true',
+                        help="resample colormaps into " + CMAP_INDEX)
+    parser.add_argument('--build-lut', action='store_true',
+                        help="build the colormap lookup table in CMAP_LUT_DIR "
+                             "(with CMAP_LUT_BITS bits per channel)")
+    parser.add_argument('--check-prefilter', action='store_true',
+                        help="report the recall of the prefilter against full "
+                             "matching on the pages given")
+    parser.add_argument('--compare-size', default=None,
+                        help="report agreement of detection on images downscaled "
+                             "to this IIIF size (e.g. '!800,800') with full size")
     args = parser.parse_args()
 
-    df = pd.concat([parse_img(x) for x in args.images], ignore_index=True, copy=False)
-    if df.size > 0:
-        has_rainbow, data = detect_rainbow_from_colors(df)
+    if args.rebuild_index:
+        save_cmap_index()
+        print('Wrote', CMAP_INDEX)
+    if args.build_lut:
+        if not CMAP_LUT_DIR:
+            parser.error("CMAP_LUT_DIR is not set")
+        print('Wrote', build_cmap_lut(CMAP_LUT_DIR).path)
+    if not args.images:
+        return
+
+    if args.compare_size:
+        df = compare_resolutions(args.images, args.compare_size)
+        print(df.to_string(index=False))
+        print('Agreement with full size: {:.1%} low-res only, {:.1%} two-pass '
+              '({:.1%} of pages refined)'.format((df['low'] == df['full']).mean(),
+              (df['two_pass'] == df['full']).mean(), df['refined'].mean()))
+        return
+
+    pdfs = [fn for fn in args.images if fn.lower().endswith('.pdf')]
+    images = [fn for fn in args.images if fn not in pdfs]
+
+    if args.check_prefilter:
+        hists = itertools.chain(ImageSource(images).hists(), *(
+            PDFSource(fn, dpi=args.dpi).hists() for fn in pdfs))
+        print('Prefilter (slack {}): {}'.format(PREFILTER_SLACK, prefilter_recall(hists)))
+        return
+
+    for fn in pdfs:
+        source = PDFSource(fn, dpi=args.dpi, extract=args.extract)
+        has_rainbow, data = detect_rainbow_from_source(source)
+        print('{} has rainbow: {}'.format(fn, has_rainbow))
+        for reason, count in sorted(source.report.items()):
+            print('  {} pages {}'.format(count, reason))
+    if images:
+        has_rainbow, data = detect_rainbow_from_source(ImageSource(images))
         print('Has rainbow:', has_rainbow)
+    if jab_cache is not None:
+        print('Colorspace cache:', jab_cache.stats())
     return
 
 if __name__ == '__main__':
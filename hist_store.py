@@ -0,0 +1,163 @@
+"""Per-page color histograms of each paper, kept so that detection can be
+rerun with different settings without retrieving the pages again
+"""
+
+import os
+import os.path
+import struct
+import zlib
+
+import numpy as np
+
+from detect_cmap import ColorHist
+
+
+class HistStore(object):
+    """One file of appended, compressed `ColorHist` records per paper
+
+        Each record is a header (magic, name length, number of colors and
+        compressed lengths) followed by the page name, the delta-encoded
+        colors and the counts. A page stored again supersedes earlier
+        records, and a partially written record (e.g. from a killed worker)
+        ends the file.
+    """
+    magic = b'JFH1'
+    header = struct.Struct('<4sHIII')
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, paper_id):
+        return os.path.join(self.root, '{}.hist'.format(paper_id))
+
+    def papers(self):
+        return sorted(fn[:-len('.hist')] for fn in os.listdir(self.root)
+                      if fn.endswith('.hist'))
+
+    def __contains__(self, paper_id):
+        return os.path.exists(self.path(paper_id))
+
+    @classmethod
+    def dump(cls, hist):
+        name = hist.name.encode('utf-8')
+        colors = np.diff(hist.colors.astype(np.int64), prepend=0)
+        colors = zlib.compress(colors.astype('<u4').tobytes())
+        counts = zlib.compress(hist.counts.astype('<u8').tobytes())
+        return b''.join([
+            cls.header.pack(cls.magic, len(name), hist.size, len(colors), len(counts)),
+            name, colors, counts])
+
+    @classmethod
+    def records(cls, data):
+        """Yields the name and compressed colors and counts of each record
+            in `data`
+        """
+        pos = 0
+        while pos + cls.header.size <= len(data):
+            magic, n_name, n_colors, n_zcolors, n_zcounts = \
+                cls.header.unpack_from(data, pos)
+            end = pos + cls.header.size + n_name + n_zcolors + n_zcounts
+            if magic != cls.magic or end > len(data):
+                break
+            pos += cls.header.size
+            name = data[pos:pos + n_name].decode('utf-8')
+            pos += n_name
+            yield name, data[pos:pos + n_zcolors], data[pos + n_zcolors:end]
+            pos = end
+
+    @classmethod
+    def parse(cls, data):
+        """Yields the `ColorHist` records in `data`
+        """
+        for name, zcolors, zcounts in cls.records(data):
+            colors = np.frombuffer(zlib.decompress(zcolors), '<u4')
+            counts = np.frombuffer(zlib.decompress(zcounts), '<u8')
+            yield ColorHist(name, np.cumsum(colors, dtype=np.uint32),
+                            counts.astype(np.int64))
+
+    def append(self, paper_id, hist):
+        # a single write per record, so concurrent appends don't interleave
+        with open(self.path(paper_id), 'ab') as fh:
+            fh.write(self.dump(hist))
+
+    def load(self, paper_id):
+        """The latest histogram stored for each page of a paper
+        """
+        with open(self.path(paper_id), 'rb') as fh:
+            data = fh.read()
+        hists = {}
+        for hist in self.parse(data):
+            hists[hist.name] = hist
+        return list(hists.values())
+
+    def names(self, paper_id):
+        """Names of the pages stored for a paper (none if not stored)
+        """
+        try:
+            with open(self.path(paper_id), 'rb') as fh:
+                data = fh.read()
+        except FileNotFoundError:
+            return set()
+        return {name for name, _, _ in self.records(data)}
+
+    def covers(self, paper_id, page_count):
+        """Whether every page of a paper (named by number, as `IIIFSource`
+            does) is stored
+        """
+        if not page_count:
+            return False
+        pages = {str(pg) for pg in range(1, page_count + 1)}
+        return pages <= self.names(paper_id)
+
+    def recording(self, paper_id, hists):
+        """Passes through `hists`, storing each `ColorHist` along the way
+
+            `PageResult`s (from the page cache) have no histogram to store,
+            and pages aren't retrieved at all once detection stops early, so
+            a paper's pages may only be partly stored (see `covers`)
+        """
+        try:
+            for hist in hists:
+                if isinstance(hist, ColorHist):
+                    self.append(paper_id, hist)
+                yield hist
+        finally:
+            if hasattr(hists, 'close'):
+                hists.close()
+
+
+def test_hist_store(tmpdir):
+    import glob
+    from detect_cmap import parse_hist, detect_rainbow_from_hists
+
+    store = HistStore(str(tmpdir))
+    fns = sorted(glob.glob("test/172627-0*"))
+    hists = [parse_hist(fn) for fn in fns]
+    for h in hists:
+        store.append('172627v1', h)
+    # stored again, and a truncated record at the end
+    store.append('172627v1', hists[0])
+    with open(store.path('172627v1'), 'ab') as fh:
+        fh.write(HistStore.dump(hists[1])[:-10])
+
+    assert store.papers() == ['172627v1']
+    assert store.names('172627v1') == {h.name for h in hists}
+    assert store.names('other') == set()
+    loaded = store.load('172627v1')
+    assert len(loaded) == len(hists)
+    by_name = lambda h: h.name
+    for h, l in zip(sorted(hists, key=by_name), sorted(loaded, key=by_name)):
+        assert h.name == l.name
+        assert np.array_equal(h.colors, l.colors)
+        assert np.array_equal(h.counts, l.counts)
+
+    pages, _ = detect_rainbow_from_hists(loaded)
+    assert sorted(pages) == [4, 12, 14, 16]
+
+    # pages named by number
+    for pg in [1, 2, 3]:
+        store.append('3pages', ColorHist(str(pg), hists[0].colors, hists[0].counts))
+    assert store.covers('3pages', 3)
+    assert not store.covers('3pages', 4)
+    assert not store.covers('3pages', None)
@@ -0,0 +1,204 @@
+"""Shared HTTP client for retrieving pages from bioRxiv and the IIIF server
+
+Connections are pooled (and kept alive) per host, with at most
+`HTTP_MAX_PER_HOST` requests to a host in flight from a process. Failed
+connections and server errors are retried with exponential backoff, and
+the requests, bytes and time spent on each host are counted.
+"""
+
+import os
+import time
+import threading
+import urllib.error
+import urllib.parse
+
+import urllib3
+
+
+HTTP_MAX_PER_HOST = int(os.environ.get('HTTP_MAX_PER_HOST', 8))
+HTTP_TIMEOUT = float(os.environ.get('HTTP_TIMEOUT', 120))
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 3))
+HTTP_BACKOFF = float(os.environ.get('HTTP_BACKOFF', 0.5))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class HTTPClient(object):
+    """Pooled, retrying and rate limited requests, safe to share between
+        threads
+    """
+    def __init__(self, max_per_host=HTTP_MAX_PER_HOST, timeout=HTTP_TIMEOUT,
+                 retries=HTTP_RETRIES, backoff=HTTP_BACKOFF):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._managers = {}
+        self._limits = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _manager(self, verify):
+        with self._lock:
+            if verify not in self._managers:
+                kw = {} if verify else dict(cert_reqs='CERT_NONE', assert_hostname=False)
+                self._managers[verify] = urllib3.PoolManager(
+                    num_pools=32, maxsize=self.max_per_host, **kw)
+            return self._managers[verify]
+
+    def _host(self, host):
+        with self._lock:
+            if host not in self._limits:
+                self._limits[host] = threading.BoundedSemaphore(self.max_per_host)
+                self._stats[host] = dict(requests=0, errors=0, bytes=0, seconds=0.0)
+            return self._limits[host], self._stats[host]
+
+    def request(self, method, url, timeout=None, retries=None,
+                retry_statuses=RETRY_STATUSES, verify=True, **kw):
+        """urllib3 response to a request, after retrying connection errors
+            and `retry_statuses` (honoring Retry-After)
+
+            Raises urllib3's errors if the connection can't be made
+        """
+        retry = urllib3.Retry(
+            total=self.retries if retries is None else retries,
+            backoff_factor=self.backoff, status_forcelist=retry_statuses,
+            raise_on_status=False)
+        limit, stats = self._host(urllib.parse.urlsplit(url).netloc)
+
+        start = time.perf_counter()
+        with limit:
+            try:
+                r = self._manager(verify).request(
+                    method, url, timeout=timeout or self.timeout, retries=retry, **kw)
+            except urllib3.exceptions.HTTPError:
+                with self._lock:
+                    stats['requests'] += 1
+                    stats['errors'] += 1
+                    stats['seconds'] += time.perf_counter() - start
+                raise
+        with self._lock:
+            stats['requests'] += 1
+            stats['errors'] += r.status >= 400
+            stats['bytes'] += len(r.data)
+            stats['seconds'] += time.perf_counter() - start
+        return r
+
+    def get(self, url, **kw):
+        """Body of a successful GET request, raising `urllib.error.HTTPError`
+            otherwise
+        """
+        r = self.request('GET', url, **kw)
+        if not 200 <= r.status < 300:
+            raise urllib.error.HTTPError(url, r.status, r.reason, r.headers, None)
+        return r.data
+
+    def get_text(self, url, **kw):
+        """Decoded body of a GET request, whatever its status
+        """
+        return self.request('GET', url, **kw).data.decode('utf-8')
+
+    def stats(self):
+        """Requests, errors (including error statuses), bytes and seconds
+            spent per host
+        """
+        with self._lock:
+            return {host: dict(s) for host, s in self._stats.items()}
+
+
+_client = {}
+
+def get_client():
+    """The client of this process (pools aren't shared with forked children)
+    """
+    pid = os.getpid()
+    if _client.get('pid') != pid:
+        _client['pid'], _client['client'] = pid, HTTPClient()
+    return _client['client']
+
+def request(method, url, **kw):
+    return get_client().request(method, url, **kw)
+
+def get(url, **kw):
+    return get_client().get(url, **kw)
+
+def get_text(url, **kw):
+    return get_client().get_text(url, **kw)
+
+def stats():
+    return get_client().stats()
+
+
+def test_http_client():
+    import http.server
+    import socketserver
+    import concurrent.futures
+
+    state = dict(connections=0, active=0, max_active=0, fail=2)
+    lock = threading.Lock()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            with lock:
+                state['connections'] += 1
+
+        def do_GET(self):
+            with lock:
+                state['active'] += 1
+                state['max_active'] = max(state['max_active'], state['active'])
+                fail = self.path == '/flaky' and state['fail'] > 0
+                if fail:
+                    state['fail'] -= 1
+            time.sleep(0.02)
+            if fail:
+                status, body = 503, b'busy'
+            elif self.path == '/missing':
+                status, body = 404, b'no such page'
+            else:
+                status, body = 200, b'x' * 1000
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            with lock:
+                state['active'] -= 1
+
+        def log_message(self, *args):
+            pass
+
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    try:
+        client = HTTPClient(max_per_host=2, retries=3, backoff=0)
+
+        # server errors are retried
+        assert client.get(base + '/flaky') == b'x' * 1000
+        assert state['fail'] == 0
+
+        # error pages can still be read
+        assert client.get_text(base + '/missing') == 'no such page'
+        try:
+            client.get(base + '/missing')
+            assert False
+        except urllib.error.HTTPError as e:
+            assert e.code == 404
+
+        # concurrency is limited and connections are reused
+        with concurrent.futures.ThreadPoolExecutor(8) as pool:
+            assert all(len(d) == 1000 for d in pool.map(client.get, [base + '/a'] * 20))
+        assert state['max_active'] <= 2
+        assert state['connections'] <= 3
+
+        s = client.stats()['127.0.0.1:{}'.format(server.server_address[1])]
+        assert s['requests'] == 23
+        assert s['errors'] == 2
+        assert s['bytes'] == 21 * 1000 + 2 * len('no such page')
+    finally:
+        server.shutdown()
+        server.server_close()
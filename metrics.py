@@ -0,0 +1,141 @@
+"""Timers and counters for the stages of a job
+
+Code that does the work reports to whatever `Metrics` is being recorded
+(nothing, outside of `recording`):
+
+    with metrics.timer('fetch'):
+        data = ...
+    metrics.count('bytes_fetched', len(data))
+"""
+
+import time
+import threading
+import contextlib
+
+import numpy as np
+
+
+class Metrics(object):
+    """Total seconds and calls per timed stage, and totals per counter
+
+        Safe to report to from several threads
+    """
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_time(self, stage, seconds, calls=1):
+        with self._lock:
+            total, n = self.timers.get(stage, (0.0, 0))
+            self.timers[stage] = (total + seconds, n + calls)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, data):
+        """Adds in the `to_dict` of another `Metrics` (e.g. from a subprocess)
+        """
+        for stage, t in data['timers'].items():
+            self.add_time(stage, t['seconds'], t['calls'])
+        for name, n in data['counters'].items():
+            self.count(name, n)
+
+    def to_dict(self):
+        with self._lock:
+            return dict(
+                timers={stage: dict(seconds=s, calls=n)
+                        for stage, (s, n) in self.timers.items()},
+                counters=dict(self.counters))
+
+
+_current = [None]
+
+@contextlib.contextmanager
+def recording():
+    """Collects what is reported within into a new `Metrics`
+    """
+    previous, _current[0] = _current[0], Metrics()
+    try:
+        yield _current[0]
+    finally:
+        _current[0] = previous
+
+@contextlib.contextmanager
+def timer(stage):
+    m = _current[0]
+    if m is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        m.add_time(stage, time.perf_counter() - start)
+
+def count(name, n=1):
+    m = _current[0]
+    if m is not None:
+        m.count(name, n)
+
+def collect(fn, *args):
+    """Calls `fn`, returning its result along with what it reported, so that
+        work done in another process can be accounted for with `merge`
+    """
+    with recording() as m:
+        return fn(*args), m.to_dict()
+
+def merge(data):
+    m = _current[0]
+    if m is not None:
+        m.merge(data)
+
+
+def summarize(jobs, percentiles=(50, 90, 99)):
+    """Percentiles of the time spent in each stage, and of each counter,
+        over `jobs` (`Metrics.to_dict`s, with 'total' seconds)
+
+        Stages and counters missing from a job count as zero
+    """
+    stages = sorted(set(s for j in jobs for s in j['timers']))
+    counters = sorted(set(c for j in jobs for c in j['counters']))
+    total = np.array([j.get('total', 0.0) for j in jobs])
+
+    def pcts(values):
+        values = np.asarray(values, dtype=float)
+        if values.size == 0:
+            return {}
+        out = {'p{}'.format(p): float(v)
+               for p, v in zip(percentiles, np.percentile(values, percentiles))}
+        out['mean'] = float(values.mean())
+        return out
+
+    summary = dict(jobs=len(jobs), total=pcts(total), stages={}, counters={})
+    for stage in stages:
+        seconds = [j['timers'].get(stage, {}).get('seconds', 0.0) for j in jobs]
+        summary['stages'][stage] = pcts(seconds)
+        summary['stages'][stage]['share'] = \
+            float(np.sum(seconds) / total.sum()) if total.sum() > 0 else None
+    for name in counters:
+        summary['counters'][name] = pcts([j['counters'].get(name, 0) for j in jobs])
+    return summary
+
+
+def test_metrics():
+    count('ignored')
+    with recording() as m:
+        with timer('a'):
+            count('pages', 2)
+        result, data = collect(lambda x: (count('pages'), x)[1], 5)
+        merge(data)
+    assert result == 5
+    d = m.to_dict()
+    assert d['counters'] == {'pages': 3}
+    assert d['timers']['a']['calls'] == 1
+
+    jobs = [dict(d, total=1.0), dict(timers={}, counters={}, total=3.0)]
+    s = summarize(jobs)
+    assert s['jobs'] == 2
+    assert s['counters']['pages']['p50'] == 1.5
+    assert s['total']['mean'] == 2.0
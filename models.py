@@ -1,19 +1,80 @@
 import json
+import base64
+import struct
+from datetime import datetime
 
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy_repr import PrettyRepresentableBase
 
+import numpy as np
 import pandas as pd
 
 from biorxiv_scraper import baseurl
+from detect_cmap import rainbow_maps
 
 db = SQLAlchemy(model_class=PrettyRepresentableBase)
 
+PARSE_DATA_COLUMNS = ['fn', 'cm', 'pct_cm', 'pct_page']
+# prefix of binary encoded parse_data (older rows hold pandas json)
+PARSE_DATA_PREFIX = 'pd1:'
+_parse_data_header = struct.Struct('<III')
+
+def encode_parse_data(df):
+    """Packs colormap detection results (`fn`, `cm` index or columns,
+    `pct_cm`, `pct_page`) into a compact, text-safe string
+
+    Page names and colormaps are stored once each, with a uint16 code per
+    row, followed by the float64 percentages
+    """
+    df = df.reset_index()
+    if df.empty:
+        df = pd.DataFrame(columns=PARSE_DATA_COLUMNS)
+    fn_codes, fns = pd.factorize(df['fn'].astype(str))
+    cm_codes, cms = pd.factorize(df['cm'].astype(str))
+    names = "\n".join(fns).encode('utf-8'), "\n".join(cms).encode('utf-8')
+    data = b''.join([
+        _parse_data_header.pack(len(df), len(names[0]), len(names[1])),
+        names[0], names[1],
+        fn_codes.astype('<u2').tobytes(), cm_codes.astype('<u2').tobytes(),
+        df['pct_cm'].values.astype('<f8').tobytes(),
+        df['pct_page'].values.astype('<f8').tobytes()])
+    return PARSE_DATA_PREFIX + base64.b64encode(data).decode('ascii')
+
+def decode_parse_data(text):
+    """Inverse of `encode_parse_data`, also reading the older pandas json
+    """
+    if not text:
+        return pd.DataFrame(columns=PARSE_DATA_COLUMNS)
+    if not text.startswith(PARSE_DATA_PREFIX):
+        return pd.read_json(text)
+
+    data = base64.b64decode(text[len(PARSE_DATA_PREFIX):])
+    n, n_fns, n_cms = _parse_data_header.unpack_from(data)
+    pos = _parse_data_header.size
+    fns = data[pos:pos + n_fns].decode('utf-8').split("\n")
+    pos += n_fns
+    cms = data[pos:pos + n_cms].decode('utf-8').split("\n")
+    pos += n_cms
+    arrays = []
+    for dtype in ['<u2', '<u2', '<f8', '<f8']:
+        size = np.dtype(dtype).itemsize * n
+        arrays.append(np.frombuffer(data, dtype=dtype, count=n, offset=pos))
+        pos += size
+    fn_codes, cm_codes, pct_cm, pct_page = arrays
+    return pd.DataFrame({
+        'fn': np.asarray(fns, dtype=object)[fn_codes] if n else [],
+        'cm': np.asarray(cms, dtype=object)[cm_codes] if n else [],
+        'pct_cm': pct_cm.astype(float), 'pct_page': pct_page.astype(float)},
+        columns=PARSE_DATA_COLUMNS)
+
 class Biorxiv(db.Model):
     source          = db.Column(db.String(10), default='biorxiv')
     id              = db.Column(db.String, primary_key=True)
     created         = db.Column(db.DateTime)
+    # changes with every update of the row, to version cached responses
+    updated         = db.Column(db.DateTime, default=datetime.utcnow,
+                                onupdate=datetime.utcnow)
     title           = db.Column(db.String)
     parse_status    = db.Column(db.Integer, default=0, nullable=False)
     _parse_data     = db.Column('parse_data', db.String)
@@ -22,21 +83,35 @@ class Biorxiv(db.Model):
     posted_date     = db.Column(db.String(10), default='')
     _author_contact = db.Column('author_contact', db.String)
     email_sent      = db.Column(db.Integer)
+    page_rows       = db.relationship('BiorxivPage', cascade='all, delete-orphan',
+                                      order_by='BiorxivPage.page')
+
+    # for the filters and keyset pagination of the home page table
+    __table_args__ = (db.Index('created_status', 'created', 'parse_status'),
+                      db.Index('posted_date_id', 'posted_date', 'id'),
+                      db.Index('parse_status_id', 'parse_status', 'id'))
 
     @hybrid_property
     def parse_data(self):
-        if self._parse_data:
-            return pd.read_json(self._parse_data)
-        else:
-            return pd.DataFrame(columns=['fn', 'cm', 'pct_cm', 'pct_page'])
+        # decoded once per object (and stored value)
+        cached = self.__dict__.get('_parse_data_cache')
+        if cached is None or cached[0] is not self._parse_data:
+            cached = (self._parse_data, decode_parse_data(self._parse_data))
+            self.__dict__['_parse_data_cache'] = cached
+        return cached[1].copy()
 
     @parse_data.setter
     def parse_data(self, df):
-        self._parse_data = df.reset_index().to_json()
+        self._parse_data = encode_parse_data(df)
+        self.page_rows = BiorxivPage.from_frame(df)
 
     @hybrid_property
     def pages(self):
-        return json.loads(self._pages)
+        """Pages with a rainbow colormap, from `page_rows` once written
+        """
+        if self.page_rows:
+            return sorted(set(r.page for r in self.page_rows if r.cm in rainbow_maps))
+        return json.loads(self._pages or '[]')
 
     @pages.setter
     def pages(self, lst):
@@ -75,3 +150,72 @@ class Biorxiv(db.Model):
 
 class Test(Biorxiv):
     pass
+
+class BiorxivPage(db.Model):
+    """A colormap found on a page of a paper (a row of `Biorxiv.parse_data`)
+    """
+    __tablename__ = 'biorxiv_page'
+    paper_id        = db.Column(db.String, db.ForeignKey('biorxiv.id'), primary_key=True)
+    page            = db.Column(db.Integer, primary_key=True)
+    cm              = db.Column(db.String, primary_key=True)
+    pct_cm          = db.Column(db.Float, nullable=False)
+    pct_page        = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (db.Index('cm_pct_cm', 'cm', 'pct_cm'),)
+
+    @classmethod
+    def from_frame(cls, df):
+        """Rows for the colormap detection results of a paper
+        """
+        df = df.reset_index()
+        return [cls(page=int(str(fn).rsplit('-', 1)[-1]), cm=cm,
+                    pct_cm=float(pct_cm), pct_page=float(pct_page))
+                for fn, cm, pct_cm, pct_page in
+                zip(df['fn'], df['cm'], df['pct_cm'], df['pct_page'])] if len(df) else []
+
+
+def test_parse_data_encoding():
+    df = pd.DataFrame({'fn': ['1', '9', '9'], 'cm': ['jet', 'jet', 'Blues'],
+                       'pct_cm': [0.5, 0.98828125, 1 / 3],
+                       'pct_page': [0.1, 0.2, 2 / 3]}).set_index(['fn', 'cm'])
+    text = encode_parse_data(df)
+    assert len(text) < len(df.reset_index().to_json())
+    pd.testing.assert_frame_equal(decode_parse_data(text), df.reset_index())
+
+    # older json rows and empty results
+    legacy = decode_parse_data(df.reset_index().to_json())
+    assert legacy['cm'].tolist() == ['jet', 'jet', 'Blues']
+    assert decode_parse_data(encode_parse_data(df.iloc[:0])).empty
+    assert decode_parse_data(None).columns.tolist() == PARSE_DATA_COLUMNS
+
+def test_page_rows():
+    df = pd.DataFrame({'fn': ['172627-009', '172627-009', '172627-011'],
+                       'cm': ['jet', 'Blues', 'Blues'], 'pct_cm': [0.9, 0.4, 0.5],
+                       'pct_page': [0.1, 0.2, 0.3]}).set_index(['fn', 'cm'])
+    rows = BiorxivPage.from_frame(df)
+    assert [(r.page, r.cm) for r in rows] == [(9, 'jet'), (9, 'Blues'), (11, 'Blues')]
+
+    b = Biorxiv(id='172627v1')
+    assert b.pages == []
+    b.parse_data = df
+    assert b.pages == [9]
+
+class JobMetrics(db.Model):
+    """Stage timings and counters (`metrics.Metrics`) of a processing job
+    """
+    __tablename__ = 'job_metrics'
+    id              = db.Column(db.Integer, primary_key=True)
+    paper_id        = db.Column(db.String, index=True)
+    created         = db.Column(db.DateTime, index=True)
+    total           = db.Column(db.Float)
+    _data           = db.Column('data', db.String)
+
+    @hybrid_property
+    def data(self):
+        data = json.loads(self._data)
+        data['total'] = self.total
+        return data
+
+    @data.setter
+    def data(self, data):
+        self._data = json.dumps(data)
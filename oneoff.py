@@ -10,7 +10,7 @@ from tqdm import tqdm
 
 from sqlalchemy import desc
 
-from models import Biorxiv
+from models import Biorxiv, PARSE_DATA_PREFIX, decode_parse_data, encode_parse_data
 from webapp import app, rq, db, process_paper
 from biorxiv_scraper import find_date
 
@@ -30,6 +30,45 @@ def add_posted_dates():
         
     return
 
+@app.cli.command()
+@click.option('--batch-size', default=500)
+def migrate_parse_data(batch_size=500):
+    """Rewrites parse_data stored as pandas json in the binary encoding
+    """
+    ids = [r.id for r in (Biorxiv.query
+                                 .with_entities(Biorxiv.id)
+                                 .filter(Biorxiv._parse_data != None,
+                                         ~Biorxiv._parse_data.startswith(PARSE_DATA_PREFIX))
+                                 .all())]
+    n_before = n_after = 0
+    for i in tqdm(range(0, len(ids), batch_size)):
+        for r in Biorxiv.query.filter(Biorxiv.id.in_(ids[i:i + batch_size])).all():
+            n_before += len(r._parse_data)
+            r._parse_data = encode_parse_data(decode_parse_data(r._parse_data))
+            n_after += len(r._parse_data)
+        db.session.commit()
+
+    print("Migrated {} records, {} to {} bytes".format(len(ids), n_before, n_after))
+    return
+
+@app.cli.command()
+@click.option('--batch-size', default=500)
+def backfill_pages(batch_size=500):
+    """Fills biorxiv_page from parse_data for records parsed before it existed
+    """
+    ids = [r.id for r in (Biorxiv.query
+                                 .with_entities(Biorxiv.id)
+                                 .filter(Biorxiv._parse_data != None,
+                                         ~Biorxiv.page_rows.any())
+                                 .all())]
+    for i in tqdm(range(0, len(ids), batch_size)):
+        for r in Biorxiv.query.filter(Biorxiv.id.in_(ids[i:i + batch_size])).all():
+            r.parse_data = r.parse_data
+        db.session.commit()
+
+    print("Backfilled {} records".format(len(ids)))
+    return
+
 @app.cli.command()
 @click.option('--head', default=None)
 @click.option('--now', is_flag=True)
@@ -1,14 +1,15 @@
 // Initiate conversion of images.
 // Separate call for which pages and retrieving images
 function retrieve_previews(id, all_pages = false) {
-  info = $('#infotemplate').clone().removeAttr('id');
-  p_preview = info.find(".paperpreview");
+  var info = $('#infotemplate').clone().removeAttr('id');
+  var p_preview = info.find(".paperpreview");
 
   // add link to details page
   info.find(".detail_link").attr("href", '/detail/' + id);
 
   function insertPages(data) {
     pdf_url = data['pdf_url'];
+    var sheet = data['sheet'];
     $.each(data['pages'], function(pg, status) {
 
       pvt = $('#pgpreviewtempl').clone().removeAttr('id');
@@ -24,16 +25,28 @@ function retrieve_previews(id, all_pages = false) {
       else
         pvt.find("a").children().addClass("preview-notdetected");
 
+      // Pages on the contact sheet are cut from it (a single image for all)
+      if (sheet && sheet['offsets'][pg]) {
+        pvt.find("img").replaceWith(sheet_tile(sheet, pg));
+        return;
+      }
+
       // Retrieve image numbers along with per-page parse statuses
       // remove placeholders
       pvt
         .find("img")
         .hide()
-        .attr("src", "/iiif/" + id + "/page/" + pg + "/full/250,/0/default.jpg")
+        .attr("src", "/thumb/" + id + "/" + pg)
         .on("load", function() {
           $(this).show().parent().find(".placeholder").remove();
         });
     });
+
+    if (sheet) {
+      $("<img>").on("load", function() {
+        p_preview.find(".sheet-tile").show().parent().find(".placeholder").remove();
+      }).attr("src", sheet['url']);
+    }
   }
 
   // get page numbers to show and initiate callback
@@ -48,3 +61,20 @@ function retrieve_previews(id, all_pages = false) {
 
   return info;
 }
+
+// A page of a contact sheet, scaled to the width of its container
+function sheet_tile(sheet, pg) {
+  var col = sheet['offsets'][pg][0] / sheet['tile'][0];
+  var row = sheet['offsets'][pg][1] / sheet['tile'][1];
+  function pct(i, n) {
+    return n > 1 ? (100 * i / (n - 1)) + '%' : '0%';
+  }
+  return $("<div>", {"class": "sheet-tile img-thumbnail mx-auto"})
+    .hide()
+    .css({
+      "padding-top": (100 * sheet['tile'][1] / sheet['tile'][0]) + '%',
+      "background-image": "url(" + sheet['url'] + ")",
+      "background-size": (100 * sheet['columns']) + '% ' + (100 * sheet['rows']) + '%',
+      "background-position": pct(col, sheet['columns']) + ' ' + pct(row, sheet['rows']),
+    });
+}
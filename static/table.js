@@ -1,15 +1,98 @@
+// Rows are loaded a page at a time from /papers (DataTables server-side mode)
+var logged_in = false;
+
+function render_status(status) {
+  if (status > 0)
+    return '<i class="far fa-eye-slash detected"></i>';
+  else if (status < 0)
+    return '<i class="far fa-check-circle notdetected"></i>';
+  return '';
+}
+
+function render_actions(status, type, row) {
+  var fix = '<button class="btn btn-dark btn-sm btn-fix">Incorrect</button>';
+  var email = '<button class="btn btn-light btn-sm btn-email">Send email</button>';
+  if (!logged_in) {
+    if (status > 0)
+      return row.email_sent ? 'Yes' : 'Not yet';
+    return '';
+  }
+  if (status > 0 && row.email_sent)
+    return 'Email sent<br/><div class="btn-group">' + fix + '</div>';
+  else if (status > 0)
+    return '<div class="btn-group">' + email + fix + '</div>';
+  else if (status < 0)
+    return '<div class="btn-group">' + fix + '</div>';
+  return '';
+}
+
+function render_link(url) {
+  return $('<a>', {href: url, target: '_blank'})
+    .append('<i class="fas fa-file-alt" alt="Link to paper"></i>')
+    .prop('outerHTML');
+}
+
+function render_text(text) {
+  return $('<div>').text(text || '').html();
+}
+
+// Cursors to the start of pages already seen, so that paging forward
+// continues from the last row instead of skipping rows
+var cursors = {};
+
+function load_papers(data, callback, settings) {
+  var order = data.order.length ? data.order[0] : {column: 2, dir: 'desc'};
+  var params = {
+    draw: data.draw,
+    start: data.start,
+    length: data.length,
+    search: data.search.value,
+    order: data.columns[order.column].name,
+    dir: order.dir,
+  };
+
+  // categories and days, as on the page url
+  new URLSearchParams(window.location.search).forEach(function(value, key) {
+    params[key] = value;
+  });
+
+  var view = JSON.stringify([params.search, params.order, params.dir, params.length]);
+  if (cursors.view !== view)
+    cursors = {view: view};
+  if (cursors[data.start])
+    params.after = cursors[data.start];
+
+  $.getJSON('/papers', params).done(function(json) {
+    if (json.next)
+      cursors[data.start + data.length] = json.next;
+    callback(json);
+  });
+}
+
 $(document).ready(function() {
+  logged_in = $('#jfTable').data('logged-in') == 1;
+
   var table = $('#jfTable').DataTable( {
+    serverSide: true,
+    ajax: load_papers,
+    searchDelay: 400,
+    order: [[2, 'desc']],
     columns: [
-        { name: 'expand'},
-        { name: 'title', "width": "65%" },
-        { name: 'date', "width": "15%" },
-        { name: 'link'},
-        { name: 'status' },
-        { name: 'authors' },
+        { name: 'expand', data: null, defaultContent: '',
+          className: 'details-control align-middle' },
+        { name: 'title', data: 'title', "width": "65%", render: render_text,
+          className: 'align-middle' },
+        { name: 'date', data: 'date', "width": "15%", render: render_text,
+          className: 'text-center align-middle' },
+        { name: 'link', data: 'url', render: render_link,
+          className: 'text-center align-middle' },
+        { name: 'status', data: 'status', render: render_status,
+          className: 'text-center align-middle' },
+        { name: 'authors', data: 'status', render: render_actions,
+          className: 'text-center align-middle' },
     ],
     'columnDefs' : [
-      { 'orderable': false, 'targets': [0] }
+      { 'orderable': false, 'targets': [0, 3, 5] }
       ],
       "pageLength": 50,
       dom: 'lrtp',
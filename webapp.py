@@ -5,7 +5,12 @@ import os
 import os.path
 import re
 import math
+import time
 import itertools
+import threading
+import tempfile
+import urllib.error
+import concurrent.futures
 from datetime import datetime, timedelta
 
 import flask
@@ -14,17 +19,27 @@ import rq_dashboard
 from flask_mail import Mail, Message
 from flask_wtf.csrf import CSRFProtect, CSRFError
 
-from sqlalchemy import desc
+import json
+import hashlib
+
+from sqlalchemy import desc, asc, or_, tuple_
+from sqlalchemy.orm import load_only
+
+import urllib3
 
 import tweepy
 
 import click
 import pytest
 
-from models import db, Biorxiv, Test
+from models import db, Biorxiv, Test, JobMetrics
 from biorxiv_scraper import find_authors, find_date, count_pages
-from detect_cmap import detect_rainbow_from_iiif
+from detect_cmap import detect_rainbow_from_iiif, get_hist_store, rescore_paper
 import utils
+import metrics
+import http_client
+from cache import DiskCache, MemoryCache, TieredCache, open_cache
+from contact_sheet import sheet_layout, make_sheet
 
 # Reads env file into environment, if found
 _ = utils.read_env()
@@ -79,49 +94,343 @@ tweepy_api = tweepy.API(tweepy_auth)
 
 app.config['IIIF_HOST'] = os.environ.get('IIIF_HOST', 'iiif-biorxiv.saladi.org')
 
+# Responses of /pages and /detail, in process and shared (redis url or a
+# directory, empty for in process only)
+app.config['RESPONSE_CACHE'] = os.environ.get('RESPONSE_CACHE', app.config['RQ_REDIS_URL'])
+response_cache = TieredCache([MemoryCache(2**24)] + (
+    [open_cache(app.config['RESPONSE_CACHE'], 2**27, prefix='jetfighter:responses:')]
+    if app.config['RESPONSE_CACHE'] else []))
+
+# Page thumbnails, fetched from the IIIF server once and kept on local disk.
+# THUMB_SIZES are the IIIF sizes served, separated by ';'
+app.config['THUMB_CACHE'] = os.environ.get('THUMB_CACHE',
+    os.path.join(tempfile.gettempdir(), 'jetfighter_thumbs'))
+app.config['THUMB_CACHE_MAX_BYTES'] = int(os.environ.get('THUMB_CACHE_MAX_BYTES', 2**30))
+app.config['THUMB_SIZES'] = os.environ.get('THUMB_SIZES', '250,').split(';')
+app.config['THUMB_TIMEOUT'] = float(os.environ.get('THUMB_TIMEOUT', 30))
+# request the previews of each paper once it has been processed
+app.config['THUMB_PREWARM'] = bool(int(os.environ.get('THUMB_PREWARM', 1)))
+thumb_cache = DiskCache(app.config['THUMB_CACHE'], app.config['THUMB_CACHE_MAX_BYTES'])
+_thumb_locks = [threading.Lock() for _ in range(64)]
+
+# Contact sheets of the pages of each paper (see contact_sheet.py)
+app.config['SHEET_CACHE'] = os.environ.get('SHEET_CACHE', app.config['THUMB_CACHE'] + '_sheets')
+app.config['SHEET_CACHE_MAX_BYTES'] = int(os.environ.get('SHEET_CACHE_MAX_BYTES', 2**28))
+sheet_cache = DiskCache(app.config['SHEET_CACHE'], app.config['SHEET_CACHE_MAX_BYTES'])
+_sheet_locks = [threading.Lock() for _ in range(16)]
+
+# most jobs summarized by /metrics at once
+app.config['METRICS_MAX_JOBS'] = int(os.environ.get('METRICS_MAX_JOBS', 5000))
+
 mail = Mail(app)
 
 @app.route('/')
 def home():
-    """Renders the website with current results
+    """Renders the website, with results loaded from `/papers`
     """
+    return flask.render_template('main.html', app=app)
 
-    cats = flask.request.args.get('categories')
+def paper_filters(args):
+    """Filters on `categories` (parse statuses) and `days` since added
+    """
+    cats = args.get('categories')
     if cats:
         cats = [int(x) for x in cats.split(',')]
     else:
         cats = [-2, -1, 1, 2]
 
-    days = flask.request.args.get('days')
+    days = args.get('days')
     if days:
         days = int(days)
     else:
         days = 3
     delta_days = datetime.now() - timedelta(days=days)
 
-    papers = (Biorxiv.query
-                     .filter(Biorxiv.parse_status.in_(cats), Biorxiv.created >= delta_days)
-                     .order_by(desc(Biorxiv.created))
-                     .limit(500)
-                     .all())
+    return [Biorxiv.parse_status.in_(cats), Biorxiv.created >= delta_days]
+
+# sortable columns of the home page table
+PAPER_ORDER = {
+    'title': Biorxiv.title,
+    'date': Biorxiv.posted_date,
+    'status': Biorxiv.parse_status,
+}
 
-    return flask.render_template('main.html', app=app, papers=papers)
+@app.route('/papers')
+def list_papers():
+    """A page of the home page table (DataTables server-side format)
+
+    Rows are filtered as on `/` and by `search` (title or id), and sorted
+    by `order` (a key of `PAPER_ORDER`) and `dir`. The response includes a
+    `next` cursor; passing it back as `after` continues from the last row
+    (keyset pagination) instead of skipping `start` rows. `length` is
+    limited to 1-500 rows; malformed parameters get a 400.
+    """
+    args = flask.request.args
+    try:
+        length = min(max(int(args.get('length', 50)), 1), 500)
+        start = int(args.get('start', 0))
+        draw = int(args.get('draw', 0))
+        after = args.get('after')
+        if after:
+            after = json.loads(after)
+            if not isinstance(after, list) or len(after) != 2 or \
+                    not all(isinstance(v, (str, int, float)) for v in after):
+                raise ValueError("after must be a cursor from `next`")
+        filters = paper_filters(args)
+        if start < 0:
+            raise ValueError("start must not be negative")
+    except (ValueError, TypeError) as e:
+        return flask.jsonify(result=False, message=str(e)), 400
+    col = PAPER_ORDER.get(args.get('order'), Biorxiv.posted_date)
+    descending = args.get('dir', 'desc') != 'asc'
+
+    query = Biorxiv.query.filter(*filters)
+    total = query.count()
+    search = args.get('search')
+    if search:
+        query = query.filter(or_(Biorxiv.title.contains(search, autoescape=True),
+                                 Biorxiv.id.startswith(search, autoescape=True)))
+        filtered = query.count()
+    else:
+        filtered = total
+
+    order = desc if descending else asc
+    query = query.order_by(order(col), order(Biorxiv.id))
+    key = tuple_(col, Biorxiv.id)
+    if after:
+        after = tuple_(*after)
+        query = query.filter(key < after if descending else key > after)
+    elif start:
+        query = query.offset(start)
+
+    papers = (query.options(load_only(Biorxiv.id, Biorxiv.title, Biorxiv.posted_date,
+                                      Biorxiv.parse_status, Biorxiv.email_sent))
+                   .limit(length)
+                   .all())
+
+    cursor = None
+    if len(papers) == length:
+        cursor = json.dumps([getattr(papers[-1], col.key), papers[-1].id])
+
+    return flask.jsonify(
+        draw=draw,
+        recordsTotal=total,
+        recordsFiltered=filtered,
+        next=cursor,
+        data=[dict(DT_RowId=p.id, title=p.title, date=p.posted_date, url=p.url,
+                   status=p.parse_status, email_sent=bool(p.email_sent))
+              for p in papers])
+
+def iiif_url(paper_id, page, iiif_path):
+    url = "https://{host}/iiif/2/biorxiv:{paper_id}.pdf/{iiif_path}?page={page}"
+    return url.format(host=app.config['IIIF_HOST'], paper_id=paper_id, iiif_path=iiif_path, page=page)
 
 @app.route('/iiif/<string:paper_id>/page/<string:page>/<path:iiif_path>')
 def iiif_resolver(paper_id, page, iiif_path):
-    url = "https://{host}/iiif/2/biorxiv:{paper_id}.pdf/{iiif_path}?page={page}"
-    url = url.format(host=app.config['IIIF_HOST'], paper_id=paper_id, iiif_path=iiif_path, page=page)
-    return flask.redirect(url)
+    return flask.redirect(iiif_url(paper_id, page, iiif_path))
+
+def fetch_thumbnail(paper_id, page, size):
+    """Jpeg of a page at IIIF `size`, from `thumb_cache` or else the IIIF server
+    """
+    key = '{}/{}/{}'.format(paper_id, page, size)
+    data = thumb_cache.get(key)
+    if data is not None:
+        return data
+
+    # fetch each thumbnail once, however many requests for it arrive at once
+    with _thumb_locks[hash(key) % len(_thumb_locks)]:
+        data = thumb_cache.get(key)
+        if data is None:
+            url = iiif_url(paper_id, page, 'full/{}/0/default.jpg'.format(size))
+            data = http_client.get(url, timeout=app.config['THUMB_TIMEOUT'], retries=1)
+            thumb_cache.put(key, data)
+    return data
+
+@app.route('/thumb/<string:paper_id>/<int:page>')
+def thumbnail(paper_id, page):
+    """Thumbnail of a page (at `size`, the first of THUMB_SIZES by default)
+    """
+    size = flask.request.args.get('size', app.config['THUMB_SIZES'][0])
+    if size not in app.config['THUMB_SIZES']:
+        flask.abort(404)
+
+    try:
+        data = fetch_thumbnail(paper_id, page, size)
+    except (urllib.error.URLError, urllib3.exceptions.HTTPError):
+        # let the client try the IIIF server itself
+        return flask.redirect(iiif_url(paper_id, page, 'full/{}/0/default.jpg'.format(size)))
+
+    response = flask.Response(data, mimetype='image/jpeg')
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    response.set_etag(hashlib.sha1('{}/{}/{}'.format(paper_id, page, size).encode('utf-8')).hexdigest())
+    return response.make_conditional(flask.request)
+
+def sheet_version(record):
+    """Changes with the pages (and detected pages) shown on a contact sheet
+    """
+    key = json.dumps([record.id, record.page_count, record.pages])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+def sheet_info(record):
+    """Where each page is on the paper's contact sheet, None without pages
+    """
+    if not record.page_count:
+        return None
+    layout = sheet_layout(record.page_count)
+    layout['url'] = flask.url_for('contact_sheet', paper_id=record.id,
+                                  version=sheet_version(record))
+    return layout
+
+@app.route('/sheet/<string:paper_id>/<string:version>.jpg')
+def contact_sheet(paper_id, version):
+    """Every page of a paper tiled in one image, detected pages outlined
+    """
+    record = Biorxiv.query.filter_by(id=paper_id).first()
+    if not record or not record.page_count:
+        flask.abort(404)
+    current = sheet_version(record)
+    if version != current:
+        return flask.redirect(flask.url_for('contact_sheet', paper_id=paper_id, version=current))
+
+    key = '{}/{}'.format(paper_id, version)
+    data = sheet_cache.get(key)
+    if data is None:
+        with _sheet_locks[hash(key) % len(_sheet_locks)]:
+            data = sheet_cache.get(key)
+            if data is None:
+                data, complete = build_sheet(record)
+                # retry missing pages next time
+                if complete:
+                    sheet_cache.put(key, data)
+
+    response = flask.Response(data, mimetype='image/jpeg')
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    response.set_etag(key)
+    return response.make_conditional(flask.request)
+
+def build_sheet(record, workers=8):
+    """Contact sheet of a paper from its thumbnails, and whether all of
+    them could be retrieved
+    """
+    size = app.config['THUMB_SIZES'][0]
+    def get(page):
+        try:
+            return page, fetch_thumbnail(record.id, page, size)
+        except (urllib.error.URLError, urllib3.exceptions.HTTPError):
+            return page, None
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        images = {page: data for page, data in
+                  pool.map(get, range(1, record.page_count + 1)) if data is not None}
+    data = make_sheet(images, record.page_count, detected=set(record.pages))
+    return data, len(images) == record.page_count
+
+def prewarm_previews(record, workers=4):
+    """Requests the contact sheet and preview thumbnails of a paper from
+    the webapp at BASE_URL, so that they are in its caches before anyone looks
+
+    Returns the number retrieved
+    """
+    paths = ['/thumb/{}/{}'.format(record.id, page)
+             for page in preview_pages(record, False)]
+    if record.page_count:
+        paths.insert(0, '/sheet/{}/{}.jpg'.format(record.id, sheet_version(record)))
+
+    def get(path):
+        try:
+            http_client.get(app.config['BASE_URL'].rstrip('/') + path,
+                       timeout=app.config['THUMB_TIMEOUT'], retries=1)
+            return True
+        except (urllib.error.URLError, urllib3.exceptions.HTTPError):
+            return False
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        return sum(pool.map(get, paths))
+
+# cached responses of each paper, by endpoint
+RESPONSE_VARIANTS = {'pages': ['', 'all'], 'detail': ['']}
+
+def paper_stamp(paper_id):
+    """When the paper's record last changed, None if there is no record
+    """
+    row = (db.session.query(Biorxiv.updated, Biorxiv.created)
+                     .filter(Biorxiv.id == paper_id)
+                     .first())
+    if row is None:
+        return None
+    return row.updated or row.created or datetime(1970, 1, 1)
+
+def invalidate_paper(paper_id):
+    """Drops the cached responses of a paper, once its record has changed
+    """
+    for name, variants in RESPONSE_VARIANTS.items():
+        for variant in variants:
+            response_cache.delete('{}:{}:{}'.format(name, paper_id, variant))
+
+def paper_response(name, paper_id, variant, stamp, build, render=None,
+                   mimetype='application/json', private=False):
+    """Response with the output of `build()` for the paper as of `stamp`,
+    from `response_cache` if there, and passed through `render` if given
+
+    Clients revalidate with the ETag (or Last-Modified) each time and get
+    a 304 unless the record has changed
+    """
+    key = '{}:{}:{}'.format(name, paper_id, variant)
+    tag = '{}:{}'.format(key, stamp.isoformat())
+    etag = hashlib.sha1(tag.encode('utf-8')).hexdigest()
+
+    # flashed messages are only shown once, so need a fresh render
+    if etag in flask.request.if_none_match and \
+            not (render and flask.session.get('_flashes')):
+        response = flask.Response(status=304)
+    else:
+        data = response_cache.get(key)
+        if data is not None and data.startswith(tag.encode('utf-8') + b'\n'):
+            body = data[len(tag) + 1:]
+        else:
+            body = build()
+            response_cache.put(key, tag.encode('utf-8') + b'\n' + body)
+        if render:
+            body = render(body)
+        response = flask.Response(body, mimetype=mimetype)
+
+    response.set_etag(etag)
+    response.last_modified = stamp
+    response.cache_control.no_cache = True
+    if private:
+        response.cache_control.private = True
+    else:
+        response.cache_control.public = True
+    return response
 
 @app.route('/pages/<string:paper_id>')
 def pages(paper_id, prepost=1, maxshow=10):
     """Pages to show for preview
     1-index I think...
     """
-    record = Biorxiv.query.filter_by(id=paper_id).first()
-    if not record:
+    stamp = paper_stamp(paper_id)
+    if stamp is None:
         return flask.jsonify({})
 
+    # if requested, show all pages with each page's status
+    try:
+        all_pages = flask.request.args.get('all') == "1"
+    except:
+        all_pages = False
+
+    def build():
+        record = Biorxiv.query.filter_by(id=paper_id).first()
+        show_pgs = preview_pages(record, all_pages, prepost, maxshow)
+        return flask.json.dumps({'pdf_url': record.pdf_url, 'pages': show_pgs,
+                                 'sheet': sheet_info(record)}).encode('utf-8')
+
+    return paper_response('pages', paper_id, 'all' if all_pages else '', stamp, build)
+
+def preview_pages(record, all_pages, prepost=1, maxshow=10):
+    """Page numbers to show (with whether each was detected)
+    """
     pages = record.pages
     page_count = record.page_count
 
@@ -136,12 +445,6 @@ def pages(paper_id, prepost=1, maxshow=10):
     # except:
     #     pass
 
-    # if requested, show all pages with each page's status
-    try:
-        all_pages = flask.request.args.get('all') == "1"
-    except:
-        all_pages = False
-
     show_pgs = {}
     if all_pages:
         for i in range(1, page_count + 1):
@@ -163,17 +466,32 @@ def pages(paper_id, prepost=1, maxshow=10):
     else:
         show_pgs = {i:False for i in range(1, maxshow + 1)}
 
-    return flask.jsonify({'pdf_url': record.pdf_url, 'pages': show_pgs})
+    return show_pgs
 
 @app.route('/detail/<string:paper_id>')
 def show_details(paper_id, prepost=1, maxshow=10):
     """
     """
-    record = Biorxiv.query.filter_by(id=paper_id).first()
-    if not record:
+    stamp = paper_stamp(paper_id)
+    if stamp is None:
         flask.flash('Sorry! Results with that ID have not been found')
         return flask.redirect('/')
 
+    # the page itself is rendered per session (csrf token, flashed messages),
+    # only the paper's part of it is cached
+    def build():
+        record = Biorxiv.query.filter_by(id=paper_id).first()
+        return json.dumps(detail_context(record)).encode('utf-8')
+
+    def render(body):
+        return flask.render_template('detail.html', **json.loads(body))
+
+    return paper_response('detail', paper_id, '', stamp, build, render,
+                          mimetype='text/html', private=True)
+
+def detail_context(record):
+    """What detail.html shows about a paper
+    """
     # Format colormap for viewing
     df_cm = record.parse_data
     if df_cm.size > 0:
@@ -194,7 +512,7 @@ def show_details(paper_id, prepost=1, maxshow=10):
         table_id="cm_parse_table", float_format='%.2f')
 
     # display images
-    return flask.render_template('detail.html',
+    return dict(
         paper_id=record.id, title=record.title, url=record.url,
         pages=", ".join([str(p) for p in record.pages]),
         parse_status=record.parse_status, email_sent=record.email_sent,
@@ -237,6 +555,7 @@ def notify_authors(paper_id, force=0):
         record.email_sent = 1
         db.session.merge(record)
         db.session.commit()
+        invalidate_paper(paper_id)
 
         return flask.jsonify(result=True, message="successfully sent")
     else:
@@ -256,11 +575,42 @@ def toggle_status(paper_id):
             return flask.jsonify(result=False, message="Not yet parsed")
         db.session.merge(record)
         db.session.commit()
+        invalidate_paper(paper_id)
 
         return flask.jsonify(result=True, message="successfully changed")
     else:
         return flask.jsonify(result=False, message="not logged in")
 
+@app.route('/metrics')
+def show_metrics():
+    """Percentiles of the time spent in each stage of the most recent
+    `n` (default 500, at most `METRICS_MAX_JOBS`) jobs, optionally only for
+    those since `days` ago
+    """
+    if not flask.session.get('logged_in'):
+        return flask.jsonify(result=False, message="not logged in")
+
+    args = flask.request.args
+    try:
+        n = int(args.get('n', 500))
+        days = float(args['days']) if args.get('days') else None
+    except ValueError:
+        n = days = -1
+    if n < 1 or (days is not None and not 0 < days < 36500):
+        return flask.jsonify(result=False,
+            message="n must be a positive integer and days a number from 0 to 36500"), 400
+    n = min(n, app.config['METRICS_MAX_JOBS'])
+
+    query = JobMetrics.query
+    if days is not None:
+        query = query.filter(JobMetrics.created >= datetime.now() - timedelta(days=days))
+    jobs = query.order_by(desc(JobMetrics.created)).limit(n).all()
+
+    summary = metrics.summarize([j.data for j in jobs])
+    if jobs:
+        summary['since'] = jobs[-1].created.isoformat()
+    return flask.jsonify(summary)
+
 """
 @app.route('/rerun', methods=['GET', 'POST'])
 @app.route('/rerun/<string:paper_id>', methods=['POST'])
@@ -383,6 +733,62 @@ def retrieve_timeline(count):
         parse_tweet(t)
 
 
+@app.cli.command()
+@click.argument('paper_ids', nargs=-1)
+@click.option('--cm-thresh', default=0.5)
+@click.option('--max-diff', default=1.0)
+@click.option('--workers', default=os.cpu_count())
+def rescore(paper_ids, cm_thresh, max_diff, workers):
+    """Recomputes results from the page histograms in `HIST_STORE`
+    (for all papers stored if none are given), without fetching pages
+
+    Papers whose status has been set by hand are left as is, and those
+    without every page stored (e.g. detection stopped early or pages came
+    from the page cache) are skipped
+    """
+    store = get_hist_store()
+    if store is None:
+        raise click.UsageError("HIST_STORE is not set")
+    if not paper_ids:
+        paper_ids = store.papers()
+    page_counts = dict(db.session.query(Biorxiv.id, Biorxiv.page_count))
+    missing = [p for p in paper_ids if p not in store or p not in page_counts]
+    paper_ids = [p for p in paper_ids if p in store and p in page_counts]
+    incomplete = []
+
+    start = time.time()
+    n_done = 0
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        results = pool.map(rescore_paper, paper_ids, itertools.repeat(store),
+                           itertools.repeat(cm_thresh), itertools.repeat(max_diff),
+                           [page_counts[p] or 0 for p in paper_ids], chunksize=4)
+        for paper_id, result in results:
+            if result is None:
+                incomplete.append(paper_id)
+                continue
+            record = Biorxiv.query.filter_by(id=paper_id).first()
+            pages, parse_data = result
+            record.pages, record.parse_data = pages, parse_data
+            if abs(record.parse_status) != 2:
+                record.parse_status = 1 if len(pages) > 0 else -1
+            db.session.merge(record)
+            invalidate_paper(paper_id)
+            n_done += 1
+            if n_done % 100 == 0:
+                db.session.commit()
+    db.session.commit()
+
+    elapsed = time.time() - start
+    print("Rescored {} papers in {:.1f}s ({:.1f} papers/s)".format(
+        n_done, elapsed, n_done / max(elapsed, 1e-9)))
+    if missing:
+        print("No stored histograms or record for {} papers: {}".format(
+            len(missing), " ".join(missing)))
+    if incomplete:
+        print("Not every page stored for {} papers (skipped): {}".format(
+            len(incomplete), " ".join(incomplete)))
+
+
 @rq.job(timeout='30m')
 def process_paper(obj):
     """Processes paper starting from url/code
@@ -392,23 +798,40 @@ def process_paper(obj):
     3. if rainbow, get authors
     4. update database entry with colormap detection and author info
     """
-    obj = db.session.merge(obj)
-    if obj.page_count == 0:
-        obj.page_count = count_pages(obj.id)
-    if obj.posted_date == "":
-        obj.posted_date = find_date(obj.id)
-    obj.pages, obj.parse_data = detect_rainbow_from_iiif(obj.id, obj.page_count)
-
-    if len(obj.pages) > 0:
-        obj.parse_status = 1
-        if obj.author_contact is None:
-            obj.author_contact = find_authors(obj.id)
-    else:
-        obj.parse_status = -1
+    start = time.time()
+    with metrics.recording() as m:
+        obj = db.session.merge(obj)
+        if obj.page_count == 0:
+            with metrics.timer('count_pages'):
+                obj.page_count = count_pages(obj.id)
+        if obj.posted_date == "":
+            with metrics.timer('find_date'):
+                obj.posted_date = find_date(obj.id)
+        with metrics.timer('detect'):
+            obj.pages, obj.parse_data = detect_rainbow_from_iiif(obj.id, obj.page_count)
+
+        if len(obj.pages) > 0:
+            obj.parse_status = 1
+            if obj.author_contact is None:
+                with metrics.timer('find_authors'):
+                    obj.author_contact = find_authors(obj.id)
+        else:
+            obj.parse_status = -1
 
-    db.session.merge(obj)
+        with metrics.timer('db_commit'):
+            db.session.merge(obj)
+            db.session.commit()
+        invalidate_paper(obj.id)
+
+    job = JobMetrics(paper_id=obj.id, created=datetime.now(),
+                     total=time.time() - start)
+    job.data = m.to_dict()
+    db.session.add(job)
     db.session.commit()
 
+    if app.config['THUMB_PREWARM']:
+        prewarm_previews(obj)
+
 
 ## NOTE: NEEDS WORK
 @pytest.fixture()